@@ -0,0 +1,67 @@
+#!/bin/bash
+
+# Compares per-frame camera conversion against the allocating conversion it replaced, and guards against regressions
+WIDTH=${1:-960}
+HEIGHT=${2:-540}
+FRAMES=${3:-200}
+ALLOCATION_LIMIT=${4:-4096}
+cd "$(dirname "$0")"
+
+for FORMAT in rgb palette classid;
+do
+    RESULT="$(CARLA_MODULE=${CARLA_MODULE:-mockcarla} PYTHONPATH=tests:$PYTHONPATH python3 -c "
+import time, tracemalloc
+import numpy as np
+from generator import FrameConverter, CITYSCAPES_PALETTE
+
+shape = ($HEIGHT, $WIDTH, 4)
+# The simulator hands listeners a buffer object, not bytes
+raw = memoryview(np.random.RandomState(0).randint(0, 13, shape, dtype=np.uint8).tobytes())
+slot = np.empty(shape, dtype=np.uint8)
+converter = FrameConverter(shape, '$FORMAT')
+
+def previous(data):
+    np.copyto(slot, np.asarray(data, np.uint8).reshape(slot.shape))
+    if '$FORMAT' == 'rgb':
+        return np.ascontiguousarray(slot[:, :, :3])
+    return CITYSCAPES_PALETTE[slot[:, :, 2]] if '$FORMAT' == 'palette' else np.ascontiguousarray(slot[:, :, 2])
+
+def current(data):
+    np.copyto(slot, np.frombuffer(data, dtype=np.uint8).reshape(slot.shape))
+    return converter.convert(slot)
+
+def measure(convert):
+    convert(raw)
+    start = time.perf_counter()
+    [convert(raw) for _ in range($FRAMES)]
+    elapsed = (time.perf_counter() - start) * 1000 / $FRAMES
+    tracemalloc.start()
+    convert(raw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+assert np.array_equal(previous(raw), current(raw))
+print('%.2f %d %.2f %d' % (measure(previous) + measure(current)))")"
+
+    if [ $? -ne 0 ];
+    then
+        echo "ERROR: unable to convert $FORMAT frames"
+        exit -1
+    fi
+
+    read PREVIOUS_MS PREVIOUS_BYTES CURRENT_MS CURRENT_BYTES <<< "$RESULT"
+    SUMMARY="$FORMAT ${WIDTH}x${HEIGHT}: $PREVIOUS_MS ms, $PREVIOUS_BYTES bytes per frame before; $CURRENT_MS ms, $CURRENT_BYTES bytes after"
+
+    if [ "$CURRENT_BYTES" -gt "$ALLOCATION_LIMIT" ];
+    then
+        echo "FAIL: $SUMMARY (allocation limit $ALLOCATION_LIMIT bytes)"
+        exit -1
+    elif awk "BEGIN { exit !($CURRENT_MS > $PREVIOUS_MS) }";
+    then
+        echo "FAIL: $SUMMARY"
+        exit -1
+    else
+        echo "PASS: $SUMMARY"
+    fi
+done
@@ -0,0 +1,37 @@
+#!/bin/bash
+
+# Guards against the lightweight tools regressing to importing the simulator, or starting slowly
+STARTUP_LIMIT=${1:-1000}
+cd "$(dirname "$0")"
+
+for MODULE in driver verifier harness;
+do
+    RESULT="$(python3 -c "
+import sys, time
+start = time.perf_counter()
+import $MODULE
+elapsed = (time.perf_counter() - start) * 1000
+loaded = [name for name in ('carla', 'psutil') if name in sys.modules]
+print('%.0f %s' % (elapsed, ','.join(loaded) or '-'))")"
+
+    if [ $? -ne 0 ];
+    then
+        echo "ERROR: unable to import $MODULE"
+        exit -1
+    fi
+
+    ELAPSED=$(cut -d' ' -f1 <<< "$RESULT")
+    LOADED=$(cut -d' ' -f2 <<< "$RESULT")
+
+    if [ "$LOADED" != "-" ];
+    then
+        echo "FAIL: $MODULE imports simulator modules ($LOADED)"
+        exit -1
+    elif [ "$ELAPSED" -gt "$STARTUP_LIMIT" ];
+    then
+        echo "FAIL: $MODULE started in $ELAPSED ms, above limit of $STARTUP_LIMIT ms"
+        exit -1
+    else
+        echo "PASS: $MODULE started in $ELAPSED ms"
+    fi
+done
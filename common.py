@@ -1,12 +1,13 @@
 import time
 import os
+import math
 import subprocess
-import signal
-import psutil
-import carla
 import yaml
 import logging
 import glob
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 VERSION = 1.0
 QUERIES_PER_TILE = 4
@@ -14,15 +15,38 @@ TILES_SCALE_MULTIPLIER = 1
 TRAFFIC_CAMERAS_PER_TILE = 4
 PANORAMIC_CAMERAS_PER_TILE = 1
 CAMERA_HEIGHT = 4
+SIDEWALK_WAYPOINT_SPACING = 2
 FPS = 30
 INITIALIZATION_FRAME_SLACK = 90
 PANORAMIC_COUNT = 4
 PANORAMIC_FOV = 120
 CONFIGURATION_FILENAME = 'configuration.yml'
+MANIFEST_FILENAME = 'manifest.yml'
 LOSSLESS_PSNR_THRESHOLD = 40
+LOSSY_PSNR_THRESHOLD = 30
 JACCARD_THRESHOLD = 0.5
 FRAME_DELTA_SECONDS = 0.04
 JITTER_LIMIT = 3.0
+WRITER_THREADS = 4
+WRITER_QUEUE_DEPTH = 8
+H264_PRESET = 'medium'
+H264_CRF = 23
+TRANSCODE_WORKERS = 4
+TRANSCODE_THREADS = 2
+TRANSCODE_RETRIES = 2
+SERVER_POLL_INTERVAL = 1
+READY_TIMEOUT = 360
+READY_INITIAL_DELAY = 0.1
+READY_MAX_DELAY = 5
+MAP_LOAD_TIMEOUT = 60
+LATENCY_PERCENTILES = [50, 95, 99]
+DEFAULT_ENCODING = {'encoder': 'h264', 'preset': H264_PRESET, 'crf': H264_CRF, 'lossless': False, 'semantic_format': 'palette'}
+TRUTH_SIDECAR_EXTENSION = '.npz'
+SEGMENTATION_TAGS = {'pedestrian': 4, 'vehicle': 10}
+
+# The libyaml bindings are much faster where available
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 CARLA_PROCESS_NAME = 'CarlaUE4'
 LICENSEPLATE_TEXTURE_PATH = '~/carla/Unreal/CarlaUE4/Content/Carla/Static/GenericMaterials/Licenseplates/Textures'
@@ -30,72 +54,155 @@ LICENSEPLATE_TEXTURE_PATH = '~/carla/Unreal/CarlaUE4/Content/Carla/Static/Generi
 maps = ['Town01', 'Town02', 'Town03', 'Town04', 'Town05']
 traffic_density = [50, 100, 200]
 pedestrian_density = [100, 250, 400]
+# Names of carla.WeatherParameters presets; resolved by the simulator module
 weather = [
-    carla.WeatherParameters.Default,
-    carla.WeatherParameters.ClearNoon,
-    carla.WeatherParameters.CloudyNoon,
-    carla.WeatherParameters.WetNoon,
-    carla.WeatherParameters.WetCloudyNoon,
-    carla.WeatherParameters.MidRainyNoon,
-    carla.WeatherParameters.HardRainNoon,
-    carla.WeatherParameters.SoftRainNoon,
-    carla.WeatherParameters.ClearSunset,
-    carla.WeatherParameters.CloudySunset,
-    carla.WeatherParameters.WetSunset,
-    carla.WeatherParameters.WetCloudySunset,
-    carla.WeatherParameters.MidRainSunset,
-    carla.WeatherParameters.HardRainSunset,
-    carla.WeatherParameters.SoftRainSunset]
+    'Default',
+    'ClearNoon',
+    'CloudyNoon',
+    'WetNoon',
+    'WetCloudyNoon',
+    'MidRainyNoon',
+    'HardRainNoon',
+    'SoftRainNoon',
+    'ClearSunset',
+    'CloudySunset',
+    'WetSunset',
+    'WetCloudySunset',
+    'MidRainSunset',
+    'HardRainSunset',
+    'SoftRainSunset']
 
 
 def load_configuration(path):
     with open(os.path.join(path, CONFIGURATION_FILENAME), 'r') as stream:
-        configuration = yaml.safe_load(stream)
+        configuration = yaml.load(stream, Loader=YAML_LOADER)
         configuration['path'] = path
         return configuration
 
 
-def is_carla_running():
-    return any([p for p in psutil.process_iter(attrs=['name'])
-                if p.info['name'] == 'CarlaUE4'])
+def get_truth_sidecar_path(video_path):
+    return os.path.splitext(video_path)[0] + TRUTH_SIDECAR_EXTENSION
 
 
-def start_carla(seed, fps=30, quality='Epic', executable=None):
-    if is_carla_running():
-        stop_carla()
+def get_checksum(filename, chunk_size=1 << 20):
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
 
-    executable = executable or os.environ['CARLA_EXECUTABLE']
-    subprocess.Popen([executable,
-                      '-benchmark',
-                      '-fps=%d' % fps,
-                      '-quality-level=%s' % quality,
-                      '-fixedseed=%d' % int(seed)], cwd=os.path.dirname(executable))
-    time.sleep(360)
 
+def wait_until(predicate, timeout, initial_delay=READY_INITIAL_DELAY, max_delay=READY_MAX_DELAY):
+    start_time = time.time()
+    delay = initial_delay
 
-def stop_carla():
-    if is_carla_running():
-        process = next(p for p in psutil.process_iter(attrs=['name'])
-                       if p.info['name'] == os.path.basename(os.environ['CARLA_EXECUTABLE']))
-        process.send_signal(signal.SIGINT)
-        time.sleep(360)
+    while not predicate():
+        remaining = start_time + timeout - time.time()
+        if remaining <= 0:
+            raise TimeoutError('Not ready after %.1f seconds' % timeout)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
 
+    return time.time() - start_time
 
-def transcode_video(input_filename, output_filename):
+
+def get_percentile(values, percentile):
+    # Linearly interpolated between the closest ranks of sorted values, as numpy.percentile
+    if not values:
+        return math.nan
+    rank = (len(values) - 1) * percentile / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize_latencies(latencies, percentiles=LATENCY_PERCENTILES):
+    latencies = sorted(latencies)
+    summary = {'count': len(latencies), 'mean': sum(latencies) / len(latencies) if latencies else math.nan}
+    summary.update(('p%d' % percentile, get_percentile(latencies, percentile)) for percentile in percentiles)
+    return summary
+
+
+def get_transcoded_filename(filename):
+    directory, basename = os.path.split(filename)
+    return os.path.join(directory, basename.lstrip('_'))
+
+
+def transcode_video(input_filename, output_filename, threads=None):
     logging.info("Compressing " + input_filename)
 
+    # Encode to a temporary name so that an interrupted run never leaves a truncated output behind
+    partial_filename = output_filename + '.partial'
+
     try:
         if subprocess.call(['ffmpeg',
                             '-y',
+                            '-loglevel', 'error',
                             '-i', input_filename,
-                            '-codec', 'h264',
-                            output_filename]) == 0:
+                            '-codec', 'h264'] +
+                           (['-threads', str(threads)] if threads else []) +
+                           ['-f', 'mp4',
+                            partial_filename]) == 0:
+            os.replace(partial_filename, output_filename)
             os.remove(input_filename)
-    except e:
+            return True
+    except OSError as e:
         logging.error(e)
 
+    return False
+
+
+class TranscodeScheduler:
+    def __init__(self, workers=TRANSCODE_WORKERS, threads=TRANSCODE_THREADS, retries=TRANSCODE_RETRIES):
+        self.pool = ThreadPoolExecutor(workers)
+        self.threads = threads
+        self.retries = retries
+        self.futures = {}
+        self.completed = 0
+        self.lock = threading.Lock()
 
-def transcode_videos(path):
+    def submit(self, filename):
+        with self.lock:
+            if filename not in self.futures:
+                self.futures[filename] = self.pool.submit(self._transcode, filename)
+            return self.futures[filename]
+
+    def submit_pending(self, path):
+        for filename in sorted(glob.glob(os.path.join(path, '_*.mp4'))):
+            self.submit(filename)
+
+    def close(self):
+        with self.lock:
+            futures = list(self.futures.values())
+        results = [future.result() for future in futures]
+        self.pool.shutdown()
+
+        if not all(results):
+            logging.error('Failed to compress %d of %d videos', results.count(False), len(results))
+        return all(results)
+
+    def _transcode(self, filename):
+        output_filename = get_transcoded_filename(filename)
+        # Inputs are removed once compressed, so an output without an input was completed by an earlier run
+        result = not os.path.exists(filename) and os.path.exists(output_filename)
+
+        for attempt in range(self.retries + 1):
+            if result:
+                break
+            result = transcode_video(filename, output_filename, self.threads)
+            if not result:
+                logging.warning('Compression attempt %d of %d failed for %s', attempt + 1, self.retries + 1, filename)
+
+        with self.lock:
+            self.completed += 1
+            logging.info('Compressed %d of %d videos', self.completed, len(self.futures))
+
+        return result
+
+
+def transcode_videos(path, workers=TRANSCODE_WORKERS, threads=TRANSCODE_THREADS):
     logging.info("Compressing dataset %s", path)
-    for filename in glob.glob(os.path.join(path, '*.mp4')):
-        transcode_video(filename, filename.replace('_', ''))
+
+    scheduler = TranscodeScheduler(workers, threads)
+    scheduler.submit_pending(path)
+    return scheduler.close()
@@ -2,11 +2,23 @@
 
 import random
 import os
+import sys
 import glob
+import io
+import json
+import time
 import argparse
 import logging
+import urllib.request
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from common import *
 
+QUERY_CHUNK_SIZE = 1024
+OUTPUT_FORMATS = ['yaml', 'jsonl']
+REPLAY_WORKERS = 16
+REPLAY_TIMEOUT = 600
+
 def remove_key(d, key):
     del d[key]
     return d
@@ -167,21 +179,387 @@ queries = {
 }
 
 
-def create_batch(id, scale, resolution, duration):
+def get_shared_paths(scale):
+    # Instances reference these lists rather than copies, which serialize as YAML aliases
+    return {
+        'traffic': get_all_traffic_video_paths(scale),
+        'panoramas': {'panorama' + str(id): get_panoramic_video_paths(id)
+                      for id in range(scale * PANORAMIC_CAMERAS_PER_TILE)}
+    }
+
+
+def with_paths(rng, paths, instances):
+    indices = rng.integers(0, len(paths['traffic']), len(instances)).tolist()
+    return [{'path': paths['traffic'][index], **instance} for index, instance in zip(indices, instances)]
+
+
+def batch_query1(rng, count, paths, resolution, duration):
+    x1 = rng.integers(0, resolution[0], count)
+    y1 = rng.integers(0, resolution[1], count)
+    t1 = rng.integers(0, duration, count)
+    x2 = rng.integers(x1 + 1, resolution[0] + 1)
+    y2 = rng.integers(y1 + 1, resolution[1] + 1)
+    t2 = rng.integers(t1 + 1, duration + 1)
+    return with_paths(rng, paths, [{'x': x, 'y': y, 't': t} for x, y, t in
+                                   zip(zip(x1.tolist(), x2.tolist()), zip(y1.tolist(), y2.tolist()), zip(t1.tolist(), t2.tolist()))])
+
+
+def batch_query2a(rng, count, paths, *args):
+    return with_paths(rng, paths, [{} for _ in range(count)])
+
+
+def batch_query2b(rng, count, paths, *args):
+    return with_paths(rng, paths, [{'d': d} for d in rng.integers(3, 21, count).tolist()])
+
+
+def batch_detections(rng, count):
+    return [{'A': 'YOLO', 'O': object} for object in rng.choice(['Pedestrian', 'Vehicle'], count).tolist()]
+
+
+def batch_query2c(rng, count, paths, *args):
+    return with_paths(rng, paths, batch_detections(rng, count))
+
+
+def batch_background(rng, count):
+    return [{'m': m, 'epsilon': epsilon} for m, epsilon in zip(rng.integers(2, 61, count).tolist(), rng.random(count).tolist())]
+
+
+def batch_query2d(rng, count, paths, *args):
+    return with_paths(rng, paths, batch_background(rng, count))
+
+
+def batch_query3(rng, count, paths, resolution, *args):
+    dx = resolution[0] // 2 ** rng.integers(1, 4, count)
+    dy = resolution[1] // 2 ** rng.integers(1, 4, count)
+    bitrates = 2 ** rng.integers(16, 23, count)
+    return with_paths(rng, paths, [{'dx': x, 'dy': y, 'B': b} for x, y, b in zip(dx.tolist(), dy.tolist(), bitrates.tolist())])
+
+
+def batch_scales(rng, count):
+    return [{'alpha': alpha, 'beta': beta} for alpha, beta in
+            zip((2 ** rng.integers(1, 6, count)).tolist(), (2 ** rng.integers(1, 6, count)).tolist())]
+
+
+def batch_query4(rng, count, paths, *args):
+    return with_paths(rng, paths, batch_scales(rng, count))
+
+
+def batch_query5(rng, count, paths, *args):
+    return with_paths(rng, paths, batch_scales(rng, count))
+
+
+def batch_query6a(rng, count, paths, *args):
+    return batch_query2c(rng, count, paths)
+
+
+def batch_query6b(rng, count, paths, *args):
+    return with_paths(rng, paths, [{'caption_path': get_random_caption_path()} for _ in range(count)])
+
+
+def batch_query7(rng, count, paths, *args):
+    return [{'paths': paths['traffic'], 'q2c': q2c, 'q6a': q6a, 'q2d': q2d}
+            for q2c, q6a, q2d in zip(batch_detections(rng, count), batch_detections(rng, count), batch_background(rng, count))]
+
+
+def batch_query8(rng, count, paths, *args):
+    plates = get_license_plates()
+    return [{'paths': paths['traffic'], 'l': plates[index].strip(), 'L': 'OpenAPLR'}
+            for index in rng.integers(0, len(plates), count).tolist()]
+
+
+def batch_query9(rng, count, paths, *args):
+    return [paths['panoramas'] for _ in range(count)]
+
+
+def batch_query10(rng, count, paths, *args):
+    bl = rng.integers(16, 22, count)
+    bh = rng.integers(bl + 1, 23)
+    return [{'bl': low, 'bh': high, 'q5': q5, **paths['panoramas']}
+            for low, high, q5 in zip(bl.tolist(), bh.tolist(), batch_scales(rng, count))]
+
+
+batch_queries = {
+    '1':  batch_query1,
+    '2a': batch_query2a,
+    '2b': batch_query2b,
+    '2c': batch_query2c,
+    '2d': batch_query2d,
+    '3':  batch_query3,
+    '4':  batch_query4,
+    '5':  batch_query5,
+    '6a': batch_query6a,
+    '6b': batch_query6b,
+    '7':  batch_query7,
+    '8':  batch_query8,
+    '9':  batch_query9,
+    '10': batch_query10
+}
+
+
+def create_instances(id, scale, resolution, duration, rng=None, paths=None, chunk_size=QUERY_CHUNK_SIZE):
+    count = scale * QUERIES_PER_TILE
+    paths = paths or get_shared_paths(scale)
+
+    # Instances are produced in chunks so that memory does not grow with scale
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+
+        # Without a generator, draw each instance in turn from the random module, as earlier releases did
+        if rng is None:
+            yield [queries[id](scale, resolution, duration) for _ in range(size)]
+        else:
+            yield batch_queries[id](rng, size, paths, resolution, duration)
+
+
+def create_batch(id, scale, resolution, duration, rng=None, paths=None):
     batch = {
         'query': id,
-        'batch': [{'query': queries[id](scale, resolution, duration)}
-                      for _ in range(scale * QUERIES_PER_TILE)]
+        'batch': [{'query': instance}
+                  for instances in create_instances(id, scale, resolution, duration, rng, paths)
+                  for instance in instances]
     }
 
     return batch #{'batch': batch}
 
 
-def benchmark(path, scale, resolution, duration):
-    result = {'source': path, 'batches': []}
-    for id in queries.keys():
-        result['batches'].append(create_batch(id, scale, resolution, duration))
-    return yaml.safe_dump(result)
+def benchmark(path, scale, resolution, duration, rng=None):
+    # The YAML document as a string, for callers of earlier releases; the driver itself streams it
+    stream = io.StringIO()
+    write_benchmark(stream, path, scale, resolution, duration, rng)
+    return stream.getvalue()
+
+
+def yaml_events(dumper, node, anchors, emitted):
+    # As yaml.Serializer, but anchors persist across the whole stream so that shared path lists are emitted once
+    anchor = anchors.get(id(node))
+    if anchor in emitted:
+        yield yaml.AliasEvent(anchor)
+        return
+    elif anchor:
+        emitted.add(anchor)
+
+    if isinstance(node, yaml.ScalarNode):
+        implicit = (node.tag == dumper.resolve(yaml.ScalarNode, node.value, (True, False)),
+                    node.tag == dumper.resolve(yaml.ScalarNode, node.value, (False, True)))
+        yield yaml.ScalarEvent(anchor, node.tag, implicit, node.value, style=node.style)
+    elif isinstance(node, yaml.SequenceNode):
+        yield yaml.SequenceStartEvent(anchor, node.tag, node.tag == dumper.resolve(yaml.SequenceNode, node.value, True),
+                                      flow_style=node.flow_style)
+        for item in node.value:
+            yield from yaml_events(dumper, item, anchors, emitted)
+        yield yaml.SequenceEndEvent()
+    else:
+        yield yaml.MappingStartEvent(anchor, node.tag, node.tag == dumper.resolve(yaml.MappingNode, node.value, True),
+                                     flow_style=node.flow_style)
+        for key, value in node.value:
+            yield from yaml_events(dumper, key, anchors, emitted)
+            yield from yaml_events(dumper, value, anchors, emitted)
+        yield yaml.MappingEndEvent()
+
+
+def write_yaml_benchmark(stream, path, batches, shared):
+    dumper = YAML_DUMPER(stream, default_flow_style=False)
+    anchors = {id(dumper.represent_data(value)): 'paths%d' % index for index, value in enumerate(shared)}
+    represented = dict(dumper.represented_objects)
+    emitted = set()
+
+    def events(data):
+        # Forget everything but the shared lists, so that memory does not grow with the document
+        dumper.represented_objects = dict(represented)
+        dumper.object_keeper = []
+        return yaml_events(dumper, dumper.represent_data(data), anchors, emitted)
+
+    dumper.emit(yaml.StreamStartEvent())
+    dumper.emit(yaml.DocumentStartEvent())
+    # Keys in sorted order, as yaml.safe_dump wrote the whole document in earlier releases
+    dumper.emit(yaml.MappingStartEvent(None, None, True))
+    [dumper.emit(event) for event in events('batches')]
+    dumper.emit(yaml.SequenceStartEvent(None, None, True))
+
+    for query, chunks in batches:
+        dumper.emit(yaml.MappingStartEvent(None, None, True))
+        [dumper.emit(event) for event in events('batch')]
+        dumper.emit(yaml.SequenceStartEvent(None, None, True))
+        for instances in chunks:
+            for instance in instances:
+                [dumper.emit(event) for event in events({'query': instance})]
+        dumper.emit(yaml.SequenceEndEvent())
+        [dumper.emit(event) for event in events('query')]
+        [dumper.emit(event) for event in events(query)]
+        dumper.emit(yaml.MappingEndEvent())
+
+    dumper.emit(yaml.SequenceEndEvent())
+    [dumper.emit(event) for event in events('source')]
+    [dumper.emit(event) for event in events(path)]
+    dumper.emit(yaml.MappingEndEvent())
+    dumper.emit(yaml.DocumentEndEvent())
+    dumper.emit(yaml.StreamEndEvent())
+    # Earlier releases printed the document, ending it with a blank line
+    stream.write('\n')
+
+
+def write_jsonl_benchmark(stream, path, batches):
+    for id, chunks in batches:
+        index = 0
+        for instances in chunks:
+            for instance in instances:
+                stream.write(json.dumps({'source': path, 'query': id, 'instance': index, 'parameters': instance}) + '\n')
+                index += 1
+
+
+def write_benchmark(stream, path, scale, resolution, duration, rng=None, format='yaml'):
+    paths = get_shared_paths(scale)
+    batches = ((id, create_instances(id, scale, resolution, duration, rng, paths)) for id in queries.keys())
+
+    if format == 'jsonl':
+        write_jsonl_benchmark(stream, path, batches)
+    else:
+        write_yaml_benchmark(stream, path, batches, [paths['traffic'], paths['panoramas']] + list(paths['panoramas'].values()))
+
+
+def parse_mix(mix):
+    # Relative weights per query type, e.g. "1:2,2a:1"; types not listed are not issued
+    if not mix:
+        return {id: 1.0 for id in queries.keys()}
+
+    weights = {}
+    for entry in mix.split(','):
+        id, _, weight = entry.strip().partition(':')
+        if id not in batch_queries:
+            raise ValueError('Unknown query {} in mix'.format(id))
+        weights[id] = float(weight or 1)
+    return weights
+
+
+def poisson_arrivals(rng, rate, count):
+    return [(arrival, None) for arrival in np.cumsum(rng.exponential(1 / rate, count)).tolist()]
+
+
+def read_trace(filename):
+    # One arrival per line: an offset in seconds, optionally followed by the query type to issue
+    arrivals = []
+
+    with open(filename, 'r') as stream:
+        for line in stream:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                if len(fields) > 1 and fields[1] not in batch_queries:
+                    raise ValueError('Unknown query {} in trace'.format(fields[1]))
+                arrivals.append((float(fields[0]), fields[1] if len(fields) > 1 else None))
+
+    start = min((arrival for arrival, _ in arrivals), default=0)
+    return sorted((arrival - start, id) for arrival, id in arrivals)
+
+
+def replay_instances(arrivals, mix, scale, resolution, duration, rng, paths=None, chunk_size=QUERY_CHUNK_SIZE):
+    ids = list(mix)
+    weights = np.array([mix[id] for id in ids])
+    paths = paths or get_shared_paths(scale)
+
+    # Query types are drawn per arrival, then the parameters of each type in one batch per chunk
+    for start in range(0, len(arrivals), chunk_size):
+        chunk = arrivals[start:start + chunk_size]
+        drawn = rng.choice(ids, len(chunk), p=weights / weights.sum()).tolist()
+        types = [id or drawn_id for (_, id), drawn_id in zip(chunk, drawn)]
+        instances = {id: iter(batch_queries[id](rng, types.count(id), paths, resolution, duration))
+                     for id in dict.fromkeys(types)}
+
+        for (arrival, _), id in zip(chunk, types):
+            yield arrival, id, next(instances[id])
+
+
+class HTTPDispatcher:
+    def __init__(self, url, source, timeout=REPLAY_TIMEOUT):
+        self.url = url
+        self.source = source
+        self.timeout = timeout
+
+    def __call__(self, query_id, instance):
+        request = urllib.request.Request(self.url,
+                                         data=json.dumps({'source': self.source, 'query': query_id, 'parameters': instance}).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class CommandDispatcher:
+    def __init__(self, template, dataset):
+        # Imported here, since the harness needs OpenCV and the verifier, which the driver otherwise does not
+        from harness import CommandSystem
+        self.system = CommandSystem(template)
+        self.dataset = dataset
+
+    def __call__(self, query_id, instance):
+        self.system(self.dataset, query_id, instance, os.devnull)
+
+
+def replay(dispatch, instances, workers=REPLAY_WORKERS):
+    origin = time.perf_counter()
+
+    def run(arrival, query_id, instance):
+        start = time.perf_counter() - origin
+        try:
+            dispatch(query_id, instance)
+            error = None
+        except Exception as e:
+            logging.warning('Q%s arriving at %.3fs failed: %s', query_id, arrival, e)
+            error = str(e)
+        return {'query': query_id, 'arrival': arrival, 'start': start, 'end': time.perf_counter() - origin, 'error': error}
+
+    # Open loop: each instance is submitted at its arrival time whether or not earlier ones have completed,
+    # and waits for a free worker; that wait is its queueing delay
+    with ThreadPoolExecutor(workers) as pool:
+        futures = []
+        for arrival, query_id, instance in instances:
+            delay = arrival - (time.perf_counter() - origin)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(run, arrival, query_id, instance))
+        return [future.result() for future in futures]
+
+
+def summarize_replay(records):
+    # Rates count the intervals between these records' own first and last arrivals and completions,
+    # so a query type is not diluted by the rest of the replay, and a lone query has no rate
+    completed = [record for record in records if record['error'] is None]
+
+    def rate(times):
+        span = max(times, default=0) - min(times, default=0)
+        return (len(times) - 1) / span if span > 0 else math.nan
+
+    return {'count': len(records),
+            'failed': len(records) - len(completed),
+            'offered': rate([record['arrival'] for record in records]),
+            'throughput': rate([record['end'] for record in completed]),
+            'queueing': summarize_latencies([record['start'] - record['arrival'] for record in completed]),
+            'latency': summarize_latencies([record['end'] - record['arrival'] for record in completed])}
+
+
+def print_replay_summary(summaries):
+    print('{:<8}{:<8}{:<8}{:<12}{:<12}{:<12}{:<12}{:<12}{:<12}{}'.format(
+        'Query', 'Count', 'Failed', 'Offered', 'Throughput', 'Queue p50', 'Queue p99', 'p50', 'p95', 'p99'))
+    for id, summary in summaries.items():
+        print('{:<8}{:<8}{:<8}{:<12.3f}{:<12.3f}{:<12.3f}{:<12.3f}{:<12.3f}{:<12.3f}{:.3f}'.format(
+            id, summary['count'], summary['failed'], summary['offered'], summary['throughput'],
+            summary['queueing']['p50'], summary['queueing']['p99'],
+            summary['latency']['p50'], summary['latency']['p95'], summary['latency']['p99']))
+
+
+def replay_benchmark(dispatch, arrivals, mix, scale, resolution, duration, rng, workers=REPLAY_WORKERS, report_filename=None):
+    logging.info('Replaying %d arrivals over %.1f seconds', len(arrivals), arrivals[-1][0] if arrivals else 0)
+
+    records = replay(dispatch, replay_instances(arrivals, mix, scale, resolution, duration, rng), workers)
+    summaries = {'all': summarize_replay(records)}
+    for id in dict.fromkeys(record['query'] for record in records):
+        summaries[id] = summarize_replay([record for record in records if record['query'] == id])
+
+    print_replay_summary(summaries)
+
+    if report_filename:
+        with open(report_filename, 'w') as stream:
+            yaml.dump({'workers': workers, 'summary': summaries, 'arrivals': records}, stream, Dumper=YAML_DUMPER)
+
+    return summaries
 
 
 if __name__ == '__main__':
@@ -194,17 +572,103 @@ if __name__ == '__main__':
         default=0,
         type=int,
         help='Random number generator seed')
+    parser.add_argument(
+        '--compatible',
+        action='store_true',
+        help='Draw each query instance in turn, reproducing the workloads of earlier releases for the same seed')
+    parser.add_argument(
+        '-f', '--format',
+        default='yaml',
+        choices=OUTPUT_FORMATS,
+        help='Emit a YAML document, or JSON Lines with one query instance per line')
+    parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='Output filename (defaults to standard output)')
+    arrivals = parser.add_mutually_exclusive_group()
+    arrivals.add_argument(
+        '--rate',
+        metavar='R',
+        default=None,
+        type=float,
+        help='Replay queries open-loop with Poisson arrivals at R queries per second rather than writing a workload')
+    arrivals.add_argument(
+        '--trace',
+        metavar='FILE',
+        default=None,
+        help='Replay queries open-loop at the arrival times (and optionally query types) listed in a trace')
+    parser.add_argument(
+        '--count',
+        metavar='N',
+        default=None,
+        type=int,
+        help='Number of Poisson arrivals to replay (defaults to one batch of each query type in the mix)')
+    parser.add_argument(
+        '--mix',
+        metavar='MIX',
+        default=None,
+        help='Comma-separated query weights for replay, e.g. "1:4,2a:1" (defaults to all queries equally)')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument(
+        '--endpoint',
+        metavar='URL',
+        default=None,
+        help='URL to which replayed queries are POSTed as JSON')
+    target.add_argument(
+        '--command',
+        metavar='TEMPLATE',
+        default=None,
+        help='Command executed for each replayed query, substituted as by the harness')
+    parser.add_argument(
+        '--workers',
+        metavar='N',
+        default=REPLAY_WORKERS,
+        type=int,
+        help='Maximum number of replayed queries in flight')
+    parser.add_argument(
+        '--report',
+        metavar='FILE',
+        default=None,
+        help='Replay report YAML filename, including every arrival')
     parser.add_argument(
         'path',
         type=str,
         help='Video dataset path')
     args = parser.parse_args()
 
+    if (args.rate or args.trace) and not (args.endpoint or args.command):
+        parser.error('replay requires --endpoint or --command')
+
     if args.seed:
         random.seed(args.seed)
 
     configuration = load_configuration(args.path)
-    print(benchmark(args.path,
-                    configuration['scale'],
-                    (configuration['resolution']['width'], configuration['resolution']['height']),
-                    configuration['duration']))
+
+    if args.rate or args.trace:
+        rng = np.random.default_rng(args.seed or None)
+        mix = parse_mix(args.mix)
+        summaries = replay_benchmark(HTTPDispatcher(args.endpoint, args.path) if args.endpoint else CommandDispatcher(args.command, configuration),
+                         read_trace(args.trace) if args.trace else
+                         poisson_arrivals(rng, args.rate, args.count or configuration['scale'] * QUERIES_PER_TILE * len(mix)),
+                         mix,
+                         configuration['scale'],
+                         (configuration['resolution']['width'], configuration['resolution']['height']),
+                         configuration['duration'],
+                         rng,
+                         args.workers,
+                         args.report)
+        sys.exit(0 if not summaries['all']['failed'] else 1)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+
+    try:
+        write_benchmark(output,
+                        args.path,
+                        configuration['scale'],
+                        (configuration['resolution']['width'], configuration['resolution']['height']),
+                        configuration['duration'],
+                        None if args.compatible else np.random.default_rng(args.seed or None),
+                        args.format)
+    finally:
+        if args.output:
+            output.close()
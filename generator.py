@@ -2,30 +2,42 @@
 
 import time
 import os
+import sys
 import subprocess
 import random
 import time
 import glob
 import itertools
-import carla
+import copy
+import queue
+import threading
 import numpy as np
 import cv2
 import argparse
 import yaml
 import logging
 from common import *
+from videowriter import FFmpegWriter
+from simulator import *
+from segmentation import *
 
 
 class Configuration:
-    def __init__(self, client, id, path, scale, resolution, duration, panorama_fov, vehicle_locations, walker_locations, traffic_camera_locations, panoramic_camera_locations):
+    def __init__(self, client, id, path, scale, resolution, duration, panorama_fov, vehicle_locations, walker_locations, traffic_camera_locations, panoramic_camera_locations, truth=False, writer_threads=WRITER_THREADS, encoding=None, seed=None):
         self.client = client
         self.id = id
         self.world = client.get_world()
+        self.blueprints = BlueprintCache(self.world)
         self.path = path
         self.scale = scale
         self.resolution = resolution
         self.duration = duration
         self.panorama_fov = panorama_fov or PANORAMIC_FOV
+        self.random = random.Random(seed)
+        self.truth = truth
+        self.encoding = encoding or DEFAULT_ENCODING
+        self.semantic_format = self.encoding.get('semantic_format', DEFAULT_ENCODING['semantic_format'])
+        self.writer_pool = WriterPool(writer_threads)
         self.all_walker_locations = self._shuffle([location for location in walker_locations])
         self.remaining_vehicle_locations = self._shuffle(list(vehicle_locations))
         self.remaining_walker_locations = self.all_walker_locations
@@ -49,17 +61,29 @@ class Configuration:
         location.z = CAMERA_HEIGHT
         return location
 
-    @staticmethod
-    def _shuffle(l):
-        random.shuffle(l)
+    def _shuffle(self, l):
+        self.random.shuffle(l)
         return l
 
     @staticmethod
-    def draw_n(f, count):
-        result = set()
-        while len(result) < count:
-            result.add(f())
-        return result
+    def draw_n(generator, locations, count):
+        # Drawn without replacement where possible; copies, since camera locations are raised in place
+        draws = generator.sample(locations, count) if count <= len(locations) else [generator.choice(locations) for _ in range(count)]
+        return [carla.Location(*location) for location in draws]
+
+
+class BlueprintCache:
+    def __init__(self, world):
+        # The library is fetched whole by each RPC, so fetch and filter it once per world
+        self.library = world.get_blueprint_library()
+        self.vehicles = list(self.library.filter('vehicle'))
+        self.walkers = list(self.library.filter('walker.pedestrian.*'))
+        self.found = {}
+
+    def find(self, name):
+        if name not in self.found:
+            self.found[name] = self.library.find(name)
+        return self.found[name]
 
 
 class Tile:
@@ -78,36 +102,205 @@ tile_pool = [Tile(*tuple) for tuple in itertools.product(maps, weather, traffic_
 SpawnActor = carla.command.SpawnActor
 SetAutopilot = carla.command.SetAutopilot
 FutureActor = carla.command.FutureActor
+DestroyActor = carla.command.DestroyActor
+
+class TruthWriter:
+    def __init__(self, filename, resolution):
+        self.filename = filename
+        self.resolution = resolution
+        self.classes = sorted(SEGMENTATION_TAGS.keys())
+        self.boxes = []
+        self.offsets = [0]
+
+    def write(self, tags):
+        for index, name in enumerate(self.classes):
+            _, _, stats, _ = cv2.connectedComponentsWithStats((tags == SEGMENTATION_TAGS[name]).view(np.uint8),
+                                                              connectivity=8)
+            self.boxes.append(np.column_stack([np.full(len(stats) - 1, index, dtype=np.int32),
+                                               stats[1:, :4].astype(np.int32)]))
+        self.offsets.append(self.offsets[-1] + sum(len(boxes) for boxes in self.boxes[-len(self.classes):]))
+
+    def release(self):
+        np.savez(self.filename,
+                 classes=np.array(self.classes),
+                 shape=np.array([self.resolution[1], self.resolution[0]]),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 boxes=np.concatenate(self.boxes) if self.boxes else np.empty((0, 5), dtype=np.int32))
+
+
+class FrameConverter:
+    def __init__(self, shape, format):
+        self.format = format
+        # Reused for every frame so that conversion never allocates
+        self.tags = np.empty(shape[:2], dtype=np.uint8)
+        self.frame = np.empty(shape[:2] + (3,), dtype=np.uint8)
+
+    @property
+    def semantic(self):
+        return self.format in SEMANTIC_FORMATS
+
+    def convert(self, bgra):
+        if not self.semantic:
+            cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=self.frame)
+            return self.frame
+
+        # Semantic tags are carried in the red channel of the raw BGRA buffer
+        cv2.extractChannel(bgra, 2, dst=self.tags)
+        if self.format == 'classid':
+            return self.tags
+
+        cv2.cvtColor(self.tags, cv2.COLOR_GRAY2BGR, dst=self.frame)
+        cv2.LUT(self.frame, CITYSCAPES_LUT, dst=self.frame)
+        return self.frame
+
+
+def get_h264_arguments(preset=H264_PRESET, crf=H264_CRF, lossless=False):
+    # Lossless output is encoded in RGB, since conversion to YUV would itself lose information
+    return (['-codec', 'libx264rgb' if lossless else 'libx264', '-preset', preset] +
+            (['-qp', '0'] if lossless else ['-crf', str(crf), '-pix_fmt', 'yuv420p']))
+
+
+class WriterPool:
+    def __init__(self, threads):
+        self.queues = [queue.Queue() for _ in range(threads)]
+        self.threads = [threading.Thread(target=self._run, args=(work,), daemon=True) for work in self.queues]
+        self.assigned = 0
+        [thread.start() for thread in self.threads]
+
+    def assign(self):
+        # Each sink is serviced by a single thread so that its frames are encoded in order
+        work = self.queues[self.assigned % len(self.queues)]
+        self.assigned += 1
+        return work
+
+    def close(self):
+        [work.put(None) for work in self.queues]
+        [thread.join() for thread in self.threads]
+
+    @staticmethod
+    def _run(work):
+        item = work.get()
+        while item is not None:
+            sink, slot = item
+            try:
+                sink.consume(slot)
+            except Exception as e:
+                logging.exception(e)
+            item = work.get()
+
+
+class FrameSink:
+    def __init__(self, pool, writer, truth, format, shape, depth=WRITER_QUEUE_DEPTH):
+        self.work = pool.assign()
+        self.writer = writer
+        self.truth = truth
+        self.converter = FrameConverter(shape, format)
+        self.depth = depth
+        self.stalls = 0
+        self.frames = 0
+        self.error = None
+        self.free = queue.Queue()
+        self.closed = threading.Event()
+        [self.free.put(np.empty(shape, dtype=np.uint8)) for _ in range(depth)]
+
+    @property
+    def pending(self):
+        return self.depth - self.free.qsize()
+
+    def submit(self, data):
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            self.stalls += 1
+            slot = self.free.get()
+
+        np.copyto(slot, np.frombuffer(data, dtype=np.uint8).reshape(slot.shape))
+        self.work.put((self, slot))
+
+    def consume(self, slot):
+        if self.closed.is_set():
+            return
+        elif slot is None:
+            try:
+                # OpenCV's writer returns nothing, so only an explicit False is a failure
+                if self.writer.release() is False:
+                    self.fail(RuntimeError('Encoder failed'))
+                if self.truth:
+                    self.truth.release()
+            except Exception as e:
+                self.fail(e)
+            finally:
+                self.closed.set()
+        elif self.error:
+            # Frames after the first error are dropped rather than fail again
+            self.free.put(slot)
+        else:
+            try:
+                frame = self.converter.convert(slot)
+                if self.truth:
+                    self.truth.write(self.converter.tags)
+                self.writer.write(frame)
+                self.frames += 1
+            except Exception as e:
+                self.fail(e)
+            finally:
+                self.free.put(slot)
+
+    def fail(self, error):
+        if not self.error:
+            logging.error('Video writer failed: %s', error)
+            self.error = error
+
+    def close(self):
+        self.work.put((self, None))
+        self.closed.wait()
+
+
+def create_writer(configuration, type, id):
+    encoding = configuration.encoding
+
+    if 'semantic' in type and configuration.semantic_format == 'classid':
+        # Raw class ids, compressed losslessly
+        filename = os.path.join(configuration.path, '%s-%03d%s' % (type, id, CLASS_VIDEO_EXTENSION))
+        return filename, FFmpegWriter(filename, FPS, configuration.resolution, FFV1_ARGUMENTS, pixel_format='gray')
+    elif encoding['encoder'] == 'mp4v':
+        # Transcoded to H.264 (and renamed) by the transcode scheduler once the tile is complete
+        filename = os.path.join(configuration.path, '_%s-%03d.mp4' % (type, id))
+        return filename, cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), FPS, configuration.resolution)
+    else:
+        filename = os.path.join(configuration.path, '%s-%03d.mp4' % (type, id))
+        return filename, FFmpegWriter(filename, FPS, configuration.resolution,
+                                      get_h264_arguments(encoding['preset'], encoding['crf'], encoding['lossless']))
 
 
 def create_listener(configuration, type, id):
     count = [-INITIALIZATION_FRAME_SLACK]
-    writer = [cv2.VideoWriter(os.path.join(configuration.path, '_%s-%03d.mp4' % (type, id)),
-                             cv2.VideoWriter_fourcc(*'mp4v'), FPS, configuration.resolution)]
+    filename, writer = create_writer(configuration, type, id)
+    truth = TruthWriter(os.path.join(configuration.path, '%s-%03d%s' % (type.replace('semantic-', ''), id, TRUTH_SIDECAR_EXTENSION)),
+                        configuration.resolution) if configuration.truth and 'semantic' in type else None
+    sink = FrameSink(configuration.writer_pool, writer, truth, configuration.semantic_format if 'semantic' in type else 'rgb',
+                     (configuration.resolution[1], configuration.resolution[0], 4))
 
     def close():
         count[0] = float("-inf")
-        writer[0].release()
-        writer.clear()
+        sink.close()
 
     def listener(image):
         if 0 <= count[0] <= FPS * configuration.duration:
-            if 'semantic' in type:
-                image.convert(carla.ColorConverter.CityScapesPalette)
-            data = image.raw_data
-            image = np.asarray(data, np.uint8).reshape(configuration.resolution[1], configuration.resolution[0], 4)[:,:,:3]
-            writer[0].write(image)
+            sink.submit(image.raw_data)
         count[0] += 1
 
     listener.close = close
     listener.count = count
+    listener.sink = sink
+    listener.filename = filename
 
     return listener
 
 
 def create_camera(configuration, type, id, transform=None, fov=90, yaw=None, location=None,
                   blueprint_name='sensor.camera.rgb'):
-    blueprint = configuration.world.get_blueprint_library().find(blueprint_name)
+    blueprint = configuration.blueprints.find(blueprint_name)
 
     blueprint.set_attribute('image_size_x', str(configuration.resolution[0]))
     blueprint.set_attribute('image_size_y', str(configuration.resolution[1]))
@@ -118,18 +311,37 @@ def create_camera(configuration, type, id, transform=None, fov=90, yaw=None, loc
         transform.location = location or transform.location
         transform.location += carla.Location(z=CAMERA_HEIGHT)
         transform.rotation.yaw = yaw or transform.rotation.yaw
-        transform.rotation.yaw += random.randint(-fov/2, fov/2) + random.choice([0, 180])
+        transform.rotation.yaw += configuration.random.randint(-fov/2, fov/2) + configuration.random.choice([0, 180])
     else:
         transform.rotation.yaw = yaw or transform.rotation.yaw
 
-    camera = configuration.world.spawn_actor(blueprint, transform)
-    listener = create_listener(configuration, type, id)
-    camera.count = listener.count
-    camera.close = listener.close
-    camera.requested_transform = transform
-    camera.listen(listener)
+    # Spawned together with the other cameras of the tile by spawn_cameras
+    return SpawnActor(blueprint, transform), type, id, transform
+
+
+def spawn_cameras(configuration, requests):
+    responses = configuration.client.apply_batch_sync([request[0] for request in requests])
+    errors = [response.error for response in responses if response.error]
 
-    return camera
+    if errors:
+        configuration.client.apply_batch_sync([DestroyActor(response.actor_id) for response in responses if not response.error])
+        raise RuntimeError('Unable to spawn %d of %d cameras: %s' % (len(errors), len(requests), errors[0]))
+
+    actors = {actor.id: actor for actor in configuration.world.get_actors([response.actor_id for response in responses])}
+    cameras = []
+
+    for response, (_, type, id, transform) in zip(responses, requests):
+        camera = actors[response.actor_id]
+        listener = create_listener(configuration, type, id)
+        camera.count = listener.count
+        camera.close = listener.close
+        camera.sink = listener.sink
+        camera.filename = listener.filename
+        camera.requested_transform = transform
+        camera.listen(listener)
+        cameras.append(camera)
+
+    return cameras
 
 
 def create_semantic_camera(configuration, id, transform, prefix='traffic'):
@@ -141,13 +353,13 @@ def create_traffic_cameras(configuration):
     tile_base_id = configuration.id * TRAFFIC_CAMERAS_PER_TILE
     for id in range(TRAFFIC_CAMERAS_PER_TILE): # scale * TRAFFIC_SCALE_MULTIPLIER):
         cameras.append(create_camera(configuration, 'traffic', tile_base_id + id))
-        cameras.append(create_semantic_camera(configuration, tile_base_id + id, transform=cameras[-1].requested_transform))
+        cameras.append(create_semantic_camera(configuration, tile_base_id + id, transform=cameras[-1][3]))
     return cameras
 
 
 def create_panoramic_camera(configuration, id):
     cameras = []
-    yaw = random.randint(0, 360)
+    yaw = configuration.random.randint(0, 360)
     transform = carla.Transform(location=configuration.next_panoramic_camera_location())
     for sub_id in range(PANORAMIC_COUNT):
         cameras.append(create_camera(configuration, 'panoramic-%03d' % id, sub_id, transform=transform, fov=configuration.panorama_fov, yaw=yaw))
@@ -164,9 +376,9 @@ def create_panoramic_cameras(configuration):
 
 
 def create_vehicle(configuration):
-    blueprint = random.choice(configuration.world.get_blueprint_library().filter('vehicle'))
+    blueprint = configuration.random.choice(configuration.blueprints.vehicles)
     if blueprint.has_attribute('color'):
-        color = random.choice(blueprint.get_attribute('color').recommended_values)
+        color = configuration.random.choice(blueprint.get_attribute('color').recommended_values)
         blueprint.set_attribute('color', color)
 
     transform = configuration.next_vehicle_location()
@@ -181,7 +393,7 @@ def create_vehicles(configuration, count):
 
 
 def create_walker(configuration, index):
-    blueprint = random.choice(configuration.world.get_blueprint_library().filter('walker.pedestrian.*'))
+    blueprint = configuration.random.choice(configuration.blueprints.walkers)
     blueprint.set_attribute('is_invincible', 'false')
 
     location = configuration.all_walker_locations[index]
@@ -196,7 +408,7 @@ def create_walkers(configuration, count):
 
     batch = [create_walker_controller(configuration, walker) for walker in walkers]
     controllers = [response for response in configuration.client.apply_batch_sync(batch, True) if not response.error]
-    actors = configuration.world.get_actors([result.actor_id for result in configuration.client.apply_batch_sync(batch, True) if not result.error])
+    actors = configuration.world.get_actors([controller.actor_id for controller in controllers])
 
     [start_walker(configuration, controller, index) for index, controller in enumerate(actors)]
 
@@ -204,42 +416,65 @@ def create_walkers(configuration, count):
 
 
 def create_walker_controller(configuration, walker):
-    blueprint = configuration.world.get_blueprint_library().find('controller.ai.walker')
+    blueprint = configuration.blueprints.find('controller.ai.walker')
     return SpawnActor(blueprint, carla.Transform(), walker.actor_id)
 
 
 def start_walker(configuration, controller, index):
     controller.start() #configuration.all_walker_locations[index])
-    controller.go_to_location(random.choice(configuration.all_walker_locations))
-    controller.set_max_speed(1 + random.random())
+    controller.go_to_location(configuration.random.choice(configuration.all_walker_locations))
+    controller.set_max_speed(1 + configuration.random.random())
 
 
 def is_complete(id, scale, cameras, duration, start_time):
     frame_count = max(0, min([camera.count[0] for camera in cameras]))
     total_frames = duration * FPS
     fps = max(frame_count / (time.time() - start_time + 0.00001), 0)
-    logging.info('Tile %d of %d: Rendered %d frames; %d remaining (%.1f FPS)', id + 1, scale, frame_count, total_frames - frame_count, fps)
+    pending = max([camera.sink.pending for camera in cameras], default=0)
+    stalls = sum(camera.sink.stalls for camera in cameras)
+    logging.info('Tile %d of %d: Rendered %d frames; %d remaining (%.1f FPS); writer queue depth %d, %d stalls',
+                 id + 1, scale, frame_count, total_frames - frame_count, fps, pending, stalls)
     return frame_count >= duration * FPS
 
 
-def generate_tile(client, path, id, tile, scale, resolution, duration, panorama_fov):
-    traffic_cameras = []
-    panoramic_cameras = []
+def is_world_ready(client, map):
+    try:
+        world = client.get_world()
+        return world.get_map().name.endswith(map) and world.wait_for_tick(READY_MAX_DELAY) is not None
+    except RuntimeError:
+        return False
+
+
+def get_sidewalk_locations(map, spacing=SIDEWALK_WAYPOINT_SPACING):
+    # Navigation draws share one process-wide generator, so sample from the map instead to keep each tile reproducible
+    sidewalks = (map.get_waypoint(waypoint.transform.location, project_to_road=True, lane_type=carla.LaneType.Sidewalk)
+                 for waypoint in map.generate_waypoints(spacing))
+    return sorted({(w.transform.location.x, w.transform.location.y, w.transform.location.z) for w in sidewalks if w})
+
+
+def generate_tile(client, path, id, tile, scale, resolution, duration, panorama_fov, truth=False, writer_threads=WRITER_THREADS, encoding=None, seed=None, map_load_timeout=MAP_LOAD_TIMEOUT):
+    cameras = []
     vehicles = []
     walkers = []
     controllers = []
 
+    load_time = time.time()
     client.load_world(tile.map)
-
-    time.sleep(10)
+    wait_until(lambda: is_world_ready(client, tile.map), map_load_timeout)
+    logging.info('Loaded map %s for tile %d in %.1f seconds', tile.map, id, time.time() - load_time)
 
     world = client.get_world()
-    world.set_weather(tile.weather)
+    map = world.get_map()
+    world.set_weather(get_weather(tile.weather))
     settings = world.get_settings()
     settings.synchronous_mode = True
     settings.fixed_delta_seconds = FRAME_DELTA_SECONDS
     world.apply_settings(settings)
 
+    # Kept apart from the configuration's generator, which is seeded identically
+    location_generator = random.Random('{}:locations'.format(seed))
+    sidewalk_locations = get_sidewalk_locations(map)
+
     configuration = Configuration(
         client,
         id=id,
@@ -248,41 +483,199 @@ def generate_tile(client, path, id, tile, scale, resolution, duration, panorama_
         resolution=resolution,
         duration=duration,
         panorama_fov=panorama_fov,
-        vehicle_locations=world.get_map().get_spawn_points(),
-        walker_locations=Configuration.draw_n(world.get_random_location_from_navigation, tile.walkers),
-        traffic_camera_locations=world.get_map().get_spawn_points(),
-        panoramic_camera_locations=Configuration.draw_n(world.get_random_location_from_navigation, tile.walkers))
+        vehicle_locations=map.get_spawn_points(),
+        walker_locations=Configuration.draw_n(location_generator, sidewalk_locations, tile.walkers),
+        traffic_camera_locations=map.get_spawn_points(),
+        panoramic_camera_locations=Configuration.draw_n(location_generator, sidewalk_locations, tile.walkers),
+        truth=truth,
+        writer_threads=writer_threads,
+        encoding=encoding,
+        seed=seed)
     start_time = time.time()
 
     try:
         walkers, controllers = create_walkers(configuration, tile.walkers)
         vehicles = create_vehicles(configuration, tile.vehicles)
-        traffic_cameras = create_traffic_cameras(configuration)
-        panoramic_cameras = create_panoramic_cameras(configuration)
+        cameras = spawn_cameras(configuration, create_traffic_cameras(configuration) + create_panoramic_cameras(configuration))
+        logging.info('Set up tile %d in %.1f seconds: %d walkers, %d vehicles, %d cameras',
+                     id, time.time() - start_time, len(walkers), len(vehicles), len(cameras))
 
-        while not is_complete(id, scale, traffic_cameras + panoramic_cameras, duration, start_time):
+        while not is_complete(id, scale, cameras, duration, start_time):
             [world.tick() for _ in range(10)]
 
     finally:
         logging.info('Destroying actors')
 
         try:
-            [camera.close() for camera in traffic_cameras + panoramic_cameras]
-            [camera.stop() for camera in traffic_cameras + panoramic_cameras]
+            [camera.close() for camera in cameras]
+            configuration.writer_pool.close()
+            [camera.stop() for camera in cameras]
             #[controller.stop() for controller in world.get_actors([c.actor_id for c in controllers])]
 
-            client.apply_batch_sync([carla.command.DestroyActor(c) for c in traffic_cameras] +
-                                    [carla.command.DestroyActor(c) for c in panoramic_cameras] +
-                                    [carla.command.DestroyActor(v.actor_id) for v in vehicles] +
-                                    [carla.command.DestroyActor(c.actor_id) for c in controllers] +
-                                    [carla.command.DestroyActor(w.actor_id) for w in walkers])
+            client.apply_batch_sync([DestroyActor(c) for c in cameras] +
+                                    [DestroyActor(v.actor_id) for v in vehicles] +
+                                    [DestroyActor(c.actor_id) for c in controllers] +
+                                    [DestroyActor(w.actor_id) for w in walkers])
         except RuntimeError as e:
             logging.error(e)
 
+        # Settings outlive the map, and a synchronous world never ticks on its own to signal the next map is ready
+        try:
+            settings.synchronous_mode = False
+            settings.fixed_delta_seconds = None
+            world.apply_settings(settings)
+        except RuntimeError as e:
+            logging.error(e)
+
+    failed = [camera.filename for camera in cameras if camera.sink.error]
+    if failed:
+        raise RuntimeError('Unable to write %d of %d videos for tile %d: %s' % (len(failed), len(cameras), id, ', '.join(failed)))
+
     logging.info('Generation complete for tile %d', id)
 
+    outputs = {camera.filename: camera.sink.frames for camera in cameras}
+    outputs.update({camera.sink.truth.filename: camera.sink.frames
+                    for camera in cameras if camera.sink.truth})
+    return outputs
+
 
-def write_configuration(path, tiles, scale, resolution, duration, panorama_fov, seed, hostname, port, timeout):
+def get_tile_seed(seed, id):
+    # Each tile draws from its own generator so that its output does not depend on which server renders it, or when
+    return '{}:{}'.format(seed, id)
+
+
+class GenerationManifest:
+    PENDING = 'pending'
+    RENDERING = 'rendering'
+    RENDERED = 'rendered'
+    TRANSCODED = 'transcoded'
+
+    def __init__(self, path, seed, tiles, resume=False):
+        self.path = path
+        self.filename = os.path.join(path, MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        self.tiles = {id: {'state': self.PENDING,
+                           'map': tile.map,
+                           'weather': str(tile.weather),
+                           'vehicles': tile.vehicles,
+                           'pedestrians': tile.walkers,
+                           'files': {}}
+                      for id, tile in enumerate(tiles)}
+
+        if resume and os.path.exists(self.filename):
+            with open(self.filename, 'r') as stream:
+                manifest = yaml.safe_load(stream)
+
+            # Tile parameters are replayed from the seed, so any difference means the runs are not comparable
+            for id, tile in self.tiles.items():
+                previous = manifest['tiles'].get(id, {})
+                if manifest['seed'] != seed or any(previous.get(key) != tile[key] for key in tile if key not in ('state', 'files')):
+                    raise RuntimeError('Manifest %s does not match tile %d generated from seed %s' % (self.filename, id, seed))
+                tile['state'] = previous['state']
+                tile['files'] = previous['files']
+
+        self.seed = seed
+        self.save()
+
+    def state(self, id):
+        return self.tiles[id]['state']
+
+    def is_intact(self, id):
+        return all(os.path.exists(os.path.join(self.path, filename)) and
+                   get_checksum(os.path.join(self.path, filename)) == entry['sha256']
+                   for filename, entry in self.tiles[id]['files'].items())
+
+    def update(self, id, state, outputs=None):
+        files = {os.path.basename(filename): {'frames': frames, 'sha256': get_checksum(filename)}
+                 for filename, frames in (outputs or {}).items()}
+
+        with self.lock:
+            self.tiles[id]['state'] = state
+            self.tiles[id]['files'] = files
+            self.save()
+
+    def save(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # Replace atomically so that a crash never leaves a truncated manifest
+        with open(self.filename + '.partial', 'w') as file:
+            yaml.dump({'version': VERSION, 'seed': self.seed, 'tiles': self.tiles}, file)
+        os.replace(self.filename + '.partial', self.filename)
+
+
+def transcode_tile(scheduler, manifest, id, outputs):
+    videos = [filename for filename in outputs if filename.endswith('.mp4')]
+    futures = [scheduler.submit(filename) for filename in videos]
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def transcoded(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        if all(future.result() for future in futures):
+            manifest.update(id, GenerationManifest.TRANSCODED,
+                            {get_transcoded_filename(filename): frames for filename, frames in outputs.items()})
+        else:
+            # Never leave a tile recorded as rendered when its videos cannot be compressed; --resume renders it again
+            logging.error('Compression failed for tile %d', id)
+            manifest.update(id, GenerationManifest.PENDING)
+
+    [future.add_done_callback(transcoded) for future in futures]
+
+
+def render_tiles(servers, timeout, path, tiles, ids, scale, resolution, duration, panorama_fov, seed, manifest, truth=False, writer_threads=WRITER_THREADS, encoding=None, scheduler=None, map_load_timeout=MAP_LOAD_TIMEOUT):
+    pending = queue.Queue()
+    [pending.put(id) for id in ids]
+    remaining = [len(ids)]
+    lock = threading.Lock()
+
+    def serve(hostname, port):
+        client = carla.Client(hostname, port)
+        client.set_timeout(timeout)
+
+        while remaining[0]:
+            try:
+                id = pending.get(timeout=SERVER_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+            logging.info('Rendering tile %d on %s:%d (%s)', id, hostname, port, tiles[id])
+
+            try:
+                manifest.update(id, GenerationManifest.RENDERING)
+                outputs = generate_tile(client, path, id, tiles[id], scale, resolution, duration, panorama_fov,
+                                        truth, writer_threads, encoding, get_tile_seed(seed, id), map_load_timeout)
+
+                # Compress this tile's videos while other tiles render; H.264 output is already final
+                if scheduler:
+                    manifest.update(id, GenerationManifest.RENDERED, outputs)
+                    transcode_tile(scheduler, manifest, id, outputs)
+                else:
+                    manifest.update(id, GenerationManifest.TRANSCODED, outputs)
+            except Exception:
+                # The tile goes back to the queue, so that it is never lost; if every server fails, render_tiles raises
+                logging.exception('Server %s:%d failed rendering tile %d; retiring server', hostname, port, id)
+                try:
+                    manifest.update(id, GenerationManifest.PENDING)
+                finally:
+                    pending.put(id)
+                return
+
+            with lock:
+                remaining[0] -= 1
+
+    workers = [threading.Thread(target=serve, args=server, daemon=True) for server in servers]
+    [worker.start() for worker in workers]
+    [worker.join() for worker in workers]
+
+    if remaining[0]:
+        raise RuntimeError('%d of %d tiles were not rendered; all servers failed' % (remaining[0], len(ids)))
+
+
+def write_configuration(path, tiles, scale, resolution, duration, panorama_fov, seed, hostname, port, timeout, servers=None):
     configuration = {
         'version': VERSION,
         'name': os.path.basename(path),
@@ -294,6 +687,7 @@ def write_configuration(path, tiles, scale, resolution, duration, panorama_fov,
         'hostname': hostname,
         'port': port,
         'timeout': timeout,
+        'servers': ['%s:%d' % server for server in servers or [(hostname, port)]],
         'tiles': [
             {'id': tileid,
              'map': tile.map,
@@ -326,31 +720,62 @@ def write_configuration(path, tiles, scale, resolution, duration, panorama_fov,
         yaml.dump(configuration, file)
 
 
-def generate(path, tiles, scale, resolution, duration, panorama_fov, seed=None, vehicles=None, walkers=None, hostname='localhost', port=2000, timeout=150):
+def generate(path, tiles, scale, resolution, duration, panorama_fov, seed=None, vehicles=None, walkers=None, hostname='localhost', port=2000, timeout=150, truth=False, writer_threads=WRITER_THREADS, encoding=None, transcode_workers=TRANSCODE_WORKERS, transcode_threads=TRANSCODE_THREADS, servers=None, ready_timeout=READY_TIMEOUT, map_load_timeout=MAP_LOAD_TIMEOUT, resume=False):
     random.seed(seed)
+    encoding = encoding or DEFAULT_ENCODING
+    scheduler = TranscodeScheduler(transcode_workers, transcode_threads) if encoding['encoder'] == 'mp4v' else None
+    # External servers are managed (and seeded) by the caller; otherwise run a single local instance
+    local = not servers
+    servers = servers or [(hostname, port)]
+
+    used_tiles = []
+    for id in range(scale * TILES_SCALE_MULTIPLIER):
+        used_tiles.append(copy.copy(random.choice(tiles)))
+        if not vehicles is None:
+            used_tiles[-1].vehicles = vehicles
+        if not walkers is None:
+            used_tiles[-1].walkers = walkers
+
+    manifest = GenerationManifest(path, seed, used_tiles, resume)
+    ids = []
+    for id in range(len(used_tiles)):
+        state = manifest.state(id)
+        intact = state in (GenerationManifest.RENDERED, GenerationManifest.TRANSCODED) and manifest.is_intact(id)
+
+        if intact and state == GenerationManifest.TRANSCODED:
+            logging.info('Skipping completed tile %d', id)
+        elif intact and scheduler:
+            logging.info('Resuming compression of tile %d', id)
+            transcode_tile(scheduler, manifest, id, {os.path.join(path, filename): entry['frames']
+                                                     for filename, entry in manifest.tiles[id]['files'].items()})
+        else:
+            if state != GenerationManifest.PENDING:
+                logging.warning('Tile %d is incomplete (%s); rendering it again', id, state)
+            ids.append(id)
+
+    compressed = True
 
     try:
-        start_carla(seed)
+        if local and ids:
+            start_carla(seed, hostname=hostname, port=port, timeout=ready_timeout)
 
-        write_configuration(path, [], scale, resolution, duration, panorama_fov, seed, hostname, port, timeout)
+        write_configuration(path, [], scale, resolution, duration, panorama_fov, seed, hostname, port, timeout, servers)
 
-        client = carla.Client(hostname, port)
-        client.set_timeout(timeout)
-        used_tiles = []
-
-        for id in range(scale * TILES_SCALE_MULTIPLIER):
-            used_tiles.append(random.choice(tiles))
-            if not vehicles is None:
-                used_tiles[-1].vehicles = vehicles
-            if not walkers is None:
-                used_tiles[-1].walkers = walkers
-            logging.info(used_tiles[-1])
-            write_configuration(path, used_tiles, scale, resolution, duration, panorama_fov, seed, hostname, port, timeout)
-            generate_tile(client, path, id, used_tiles[-1], scale, resolution, duration, panorama_fov)
-
-        transcode_videos(path)
+        render_tiles(servers, timeout, path, used_tiles, ids, scale, resolution, duration, panorama_fov, seed, manifest,
+                     truth, writer_threads, encoding, scheduler, map_load_timeout)
+
+        write_configuration(path, used_tiles, scale, resolution, duration, panorama_fov, seed, hostname, port, timeout, servers)
     finally:
-        stop_carla()
+        if local and ids:
+            stop_carla(ready_timeout)
+        if scheduler:
+            compressed = scheduler.close()
+
+    return compressed
+
+
+def parse_servers(value):
+    return [(hostname, int(port)) for hostname, port in (server.rsplit(':', 1) for server in value.split(','))]
 
 
 if __name__ == '__main__':
@@ -414,6 +839,73 @@ if __name__ == '__main__':
         default=2000,
         type=int,
         help='Server engine port')
+    parser.add_argument(
+        '--servers',
+        metavar='HOST:PORT,...',
+        default=None,
+        type=parse_servers,
+        help='Render tiles across these already-running server engines rather than a local instance')
+    parser.add_argument(
+        '--ready-timeout',
+        metavar='SECONDS',
+        default=READY_TIMEOUT,
+        type=float,
+        help='Maximum time to wait for a local server engine to start or stop')
+    parser.add_argument(
+        '--map-load-timeout',
+        metavar='SECONDS',
+        default=MAP_LOAD_TIMEOUT,
+        type=float,
+        help='Maximum time to wait for a map to load')
+    parser.add_argument(
+        '--writer-threads',
+        metavar='THREADS',
+        default=WRITER_THREADS,
+        type=int,
+        help='Number of threads encoding camera frames')
+    parser.add_argument(
+        '--encoder',
+        default=DEFAULT_ENCODING['encoder'],
+        choices=['h264', 'mp4v'],
+        help='Encode directly to H.264, or write MPEG-4 Part 2 and transcode after generation')
+    parser.add_argument(
+        '--preset',
+        default=DEFAULT_ENCODING['preset'],
+        help='H.264 encoder preset')
+    parser.add_argument(
+        '--crf',
+        default=DEFAULT_ENCODING['crf'],
+        type=int,
+        help='H.264 constant rate factor')
+    parser.add_argument(
+        '--lossless',
+        action='store_true',
+        help='Encode losslessly (H.264 encoder only)')
+    parser.add_argument(
+        '--semantic-format',
+        default=DEFAULT_ENCODING['semantic_format'],
+        choices=SEMANTIC_FORMATS,
+        help='Store semantic segmentation as CityScapes palette video, or as lossless single-channel class ids')
+    parser.add_argument(
+        '--transcode-workers',
+        metavar='WORKERS',
+        default=TRANSCODE_WORKERS,
+        type=int,
+        help='Number of videos transcoded concurrently (mp4v encoder only)')
+    parser.add_argument(
+        '--transcode-threads',
+        metavar='THREADS',
+        default=TRANSCODE_THREADS,
+        type=int,
+        help='Threads used by each transcoding process (mp4v encoder only)')
+    parser.add_argument(
+        '--truth',
+        action='store_true',
+        help='Write exact per-frame ground truth sidecars alongside semantic segmentation videos')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume an interrupted generation, skipping tiles that the manifest records as complete')
     parser.add_argument(
         'path',
         help='Dataset output path')
@@ -422,4 +914,11 @@ if __name__ == '__main__':
     if not os.path.isabs(args.path):
         args.path = os.path.join(os.environ['OUTPUT_PATH'], args.path)
 
-    generate(args.path, tile_pool, args.scale, (args.width, args.height), args.duration, args.fov, args.seed, args.vehicles, args.pedestrians)
+    sys.exit(0 if generate(args.path, tile_pool, args.scale, (args.width, args.height), args.duration, args.fov, args.seed, args.vehicles, args.pedestrians,
+                   args.hostname, args.port,
+                   truth=args.truth, writer_threads=args.writer_threads,
+                   encoding={'encoder': args.encoder, 'preset': args.preset, 'crf': args.crf, 'lossless': args.lossless,
+                             'semantic_format': args.semantic_format},
+                   transcode_workers=args.transcode_workers, transcode_threads=args.transcode_threads,
+                   servers=args.servers, ready_timeout=args.ready_timeout, map_load_timeout=args.map_load_timeout,
+                   resume=args.resume) else 1)
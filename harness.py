@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import shlex
+import time
+import argparse
+import importlib
+import logging
+import subprocess
+import itertools
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from common import *
+import verifier
+from segmentation import FFV1_ARGUMENTS
+from videowriter import FFmpegWriter
+
+RESULTS_PATH = 'results'
+RESULTS_FILENAME = 'results.yml'
+RESULT_EXTENSION = '.mkv'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # As http.server.ThreadingHTTPServer, which is not available before Python 3.7
+    daemon_threads = True
+
+
+def get_input_filename(dataset, instance):
+    return os.path.join(dataset['path'], instance['path']) if 'path' in instance else dataset['path']
+
+
+class CommandSystem:
+    def __init__(self, template):
+        self.template = shlex.split(template)
+
+    def __call__(self, dataset, query_id, instance, output_filename):
+        fields = dict(instance,
+                      query=query_id,
+                      input=get_input_filename(dataset, instance),
+                      output=output_filename,
+                      parameters=json.dumps(instance))
+        subprocess.run([token.format_map(fields) for token in self.template], check=True)
+
+
+def get_output_filenames(path, query_id, index, instance, resolution):
+    # Q3 produces one video per tile, named by row and column in row-major order
+    filename = os.path.join(path, 'result-q{}-{}{}'.format(query_id, index, RESULT_EXTENSION))
+    if query_id != '3':
+        return filename, filename
+
+    stem = os.path.splitext(filename)[0]
+    return filename, ['{}-{}-{}{}'.format(stem, row, column, RESULT_EXTENSION)
+                      for row in range(-(-resolution[1] // instance['dy']))
+                      for column in range(-(-resolution[0] // instance['dx']))]
+
+
+def get_tile_arguments(bitrate):
+    # 4:4:4 chroma, since tiles of a 1080-row source can have an odd height
+    return ['-codec', 'h264', '-pix_fmt', 'yuv444p',
+            '-b:v', str(bitrate), '-maxrate', str(bitrate), '-bufsize', str(bitrate), '-f', 'matroska']
+
+
+def write_video(filename, frames, fps, arguments=FFV1_ARGUMENTS):
+    writer = None
+
+    try:
+        for frame in frames:
+            if writer is None:
+                writer = FFmpegWriter(filename, fps, frame.shape[1::-1], arguments, 'gray' if frame.ndim == 2 else 'bgr24')
+            writer.write(frame)
+    finally:
+        if writer is not None and not writer.release():
+            raise RuntimeError('Failed to encode {}'.format(filename))
+
+
+def write_tiles(filename, frames, fps, width, height, arguments):
+    stem = os.path.splitext(filename)[0]
+    writers = {}
+
+    try:
+        for frame in frames:
+            for top in range(0, frame.shape[0], height):
+                for left in range(0, frame.shape[1], width):
+                    tile = frame[top:top + height, left:left + width]
+                    key = (top // height, left // width)
+                    if key not in writers:
+                        writers[key] = FFmpegWriter('{}-{}-{}{}'.format(stem, *key, RESULT_EXTENSION),
+                                                    fps, tile.shape[1::-1], arguments)
+                    writers[key].write(tile)
+    finally:
+        if not all([writer.release() for writer in writers.values()]):
+            raise RuntimeError('Failed to encode tiles of {}'.format(filename))
+
+
+def write_upscaled(filename, frames, fps, alpha, beta, memory_limit=verifier.STRIP_MEMORY_LIMIT * 2**20):
+    # Upscaled frames can be gigabytes each, so they are produced and piped to the encoder a strip at a time
+    writer = None
+
+    try:
+        for frame in frames:
+            height, width = frame.shape[:2]
+            if writer is None:
+                writer = FFmpegWriter(filename, fps, (width*alpha, height*beta), FFV1_ARGUMENTS)
+                rows = max(1, memory_limit // (width * 3 * alpha * beta * verifier.STRIP_BYTES_PER_SAMPLE))
+            for top in range(0, height, rows):
+                writer.write(verifier.upscale_strip(frame, top, min(top + rows, height), alpha, beta))
+    finally:
+        if writer is not None and not writer.release():
+            raise RuntimeError('Failed to encode {}'.format(filename))
+
+
+def draw_truth_boxes(source_filename, frames, objects):
+    track = verifier.get_truth_track(source_filename, objects)
+    if not track.complete:
+        raise RuntimeError('No ground truth for {}'.format(source_filename))
+
+    # Drawn exactly as the verifier expects boxes to be drawn
+    for frame, boxes in zip(frames, track.boxes):
+        yield verifier.draw_boxes(frame, np.concatenate(boxes))
+
+
+REFERENCE_FRAMES = {
+    '1':  verifier.validate_q1,
+    '2a': verifier.validate_q2a,
+    '2b': verifier.validate_q2b,
+    '2d': verifier.validate_q2d,
+    '5':  verifier.validate_q5
+}
+
+
+def reference_system(dataset, query_id, instance, output_filename):
+    # A stand-in system under test that answers each query with the verifier's own reference implementation
+    source_filename = get_input_filename(dataset, instance)
+    frames = verifier.read_frames(source_filename)
+    fps = verifier.get_fps(source_filename)
+
+    if query_id in REFERENCE_FRAMES:
+        write_video(output_filename, REFERENCE_FRAMES[query_id](instance, frames), fps)
+    elif query_id == '2c':
+        objects = instance['objects'] if 'objects' in instance else ['pedestrian', 'vehicle']
+        palette = np.array([(0, 0, 0)] + [verifier.SEGMENT_COLORS[object] for object in objects], dtype=np.uint8)
+        write_video(output_filename,
+                    (palette[labels] for labels in verifier.truth_labels(source_filename, frames, objects)), fps)
+    elif query_id == '3':
+        write_tiles(output_filename, frames, fps, instance['dx'], instance['dy'], get_tile_arguments(instance['B']))
+    elif query_id == '4':
+        write_upscaled(output_filename, frames, fps, instance['alpha'], instance['beta'])
+    elif query_id == '6a':
+        objects = [instance['O'].lower()] if 'O' in instance else ['pedestrian', 'vehicle']
+        write_video(output_filename, draw_truth_boxes(source_filename, frames, objects), fps)
+    elif query_id == '6b':
+        captions = verifier.load_captions(verifier.get_caption_path(dataset, instance))
+        write_video(output_filename, verifier.caption_frames(captions, fps, frames), fps)
+    else:
+        raise RuntimeError('Q{} is not supported by the reference system'.format(query_id))
+
+# Other queries are skipped rather than run and failed
+reference_system.queries = set(REFERENCE_FRAMES) | {'2c', '3', '4', '6a', '6b'}
+
+
+PLUGINS = {
+    'reference': reference_system
+}
+
+
+def load_plugin(name):
+    if name in PLUGINS:
+        return PLUGINS[name]
+
+    # Otherwise a module name, optionally followed by ':function' (defaults to 'execute')
+    module, _, function = name.partition(':')
+    return getattr(importlib.import_module(module), function or 'execute')
+
+
+def run_instance(system, dataset, query_id, index, instance, output_filename):
+    start_time = time.perf_counter()
+
+    try:
+        system(dataset, query_id, instance, output_filename)
+        error = None
+    except Exception as e:
+        logging.exception('Q%s instance %d failed', query_id, index)
+        error = str(e)
+
+    return {'index': index, 'latency': time.perf_counter() - start_time, 'error': error}
+
+
+def run_batch(system, dataset, query_id, instances, outputs, concurrency):
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        futures = [pool.submit(run_instance, system, dataset, query_id, index, instance, output)
+                   for index, (instance, output) in enumerate(zip(instances, outputs))]
+        timings = [future.result() for future in futures]
+
+    elapsed = time.perf_counter() - start_time
+    succeeded = [timing['latency'] for timing in timings if timing['error'] is None]
+
+    return {'query': query_id,
+            'elapsed': elapsed,
+            'failed': len(timings) - len(succeeded),
+            'throughput': len(succeeded) / elapsed if elapsed > 0 else math.nan,
+            'latency': summarize_latencies(succeeded),
+            'instances': timings}
+
+
+def print_summary(runs):
+    print('{:<8}{:<6}{:<6}{:<11}{:<8}{:<12}{:<10}{:<10}{}'.format(
+        'Query', 'Run', 'Kind', 'Instances', 'Failed', 'Throughput', 'p50', 'p95', 'p99'))
+    for run in runs:
+        print('{:<8}{:<6}{:<6}{:<11}{:<8}{:<12.3f}{:<10.3f}{:<10.3f}{:.3f}'.format(
+            run['query'], run['run'], run['kind'], len(run['instances']), run['failed'], run['throughput'],
+            run['latency']['p50'], run['latency']['p95'], run['latency']['p99']))
+
+
+def execute(batch_set, queries_filename, dataset_path, system, output_path=RESULTS_PATH, concurrency=1,
+            cold_runs=1, warm_runs=1, reset_command=None, report_filename=None, verify=False,
+            cache_path=verifier.WORKLOAD_CACHE_PATH):
+    queries = verifier.load_queries(queries_filename, cache_path)
+    dataset_path = dataset_path or queries['source']
+    dataset = load_configuration(dataset_path)
+    resolution = dataset['resolution']['width'], dataset['resolution']['height']
+    batch_set = [query_id for query_id in batch_set or queries['queries'] if query_id in queries['queries']]
+    # A system may list the queries it supports, as the reference system does
+    unsupported = [query_id for query_id in batch_set if query_id not in getattr(system, 'queries', batch_set)]
+    if unsupported:
+        logging.warning('Skipping Q%s, not supported by the system under test', ', Q'.join(unsupported))
+        batch_set = [query_id for query_id in batch_set if query_id not in unsupported]
+    runs = []
+    results = []
+
+    os.makedirs(output_path, exist_ok=True)
+
+    for query_id in batch_set:
+        instances = verifier.get_queries(queries, query_id)
+        filenames = [get_output_filenames(output_path, query_id, index, instance, resolution)
+                     for index, instance in enumerate(instances)]
+
+        # Cold runs follow the reset command (e.g., restarting the system or dropping caches); warm runs do not
+        for run in range(cold_runs + warm_runs):
+            kind = 'cold' if run < cold_runs else 'warm'
+            if kind == 'cold' and reset_command:
+                subprocess.run(reset_command, shell=True, check=True)
+
+            logging.info('Executing Q%s (%s run %d, %d instances)', query_id, kind, run, len(instances))
+            runs.append(dict(run_batch(system, dataset, query_id, instances, [output for output, _ in filenames], concurrency),
+                             run=run, kind=kind))
+
+        results.append({'query': query_id, 'result': [result for _, result in filenames]})
+
+    results_filename = os.path.join(output_path, RESULTS_FILENAME)
+    with open(results_filename, 'w') as stream:
+        yaml.dump(results, stream, Dumper=YAML_DUMPER)
+
+    if report_filename:
+        with open(report_filename, 'w') as stream:
+            yaml.dump({'source': dataset_path, 'concurrency': concurrency, 'runs': runs}, stream, Dumper=YAML_DUMPER)
+
+    print_summary(runs)
+
+    passed = not any(run['failed'] for run in runs)
+    if verify:
+        passed = verifier.validate([query_id for query_id in batch_set if query_id in verifier.VERIFIERS],
+                                   queries_filename, dataset_path, results_filename, cache_path=cache_path) and passed
+
+    return passed
+
+
+def serve(system, port, dataset_path=None, output_path=RESULTS_PATH):
+    # Executes queries POSTed as JSON by the driver's replay mode, so that a system can be load tested
+    datasets = {}
+    requests = itertools.count()
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            path = dataset_path or request['source']
+            if path not in datasets:
+                datasets[path] = load_configuration(path)
+            dataset = datasets[path]
+            resolution = dataset['resolution']['width'], dataset['resolution']['height']
+            index = next(requests)
+            output, _ = get_output_filenames(output_path, request['query'], index, request['parameters'], resolution)
+
+            timing = run_instance(system, dataset, request['query'], index, request['parameters'], output)
+            body = json.dumps(timing).encode()
+
+            self.send_response(200 if timing['error'] is None else 500)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    os.makedirs(output_path, exist_ok=True)
+    server = ThreadingHTTPServer(('', port), QueryHandler)
+    logging.info('Serving queries on port %d', port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Execute a driver workload against a system under test and time it')
+    parser.add_argument(
+        '-b', '--batches',
+        metavar='B',
+        default='all',
+        type=str,
+        help='Comma-separated list of query batches to execute (e.g., "1,2a") or "all"')
+    parser.add_argument(
+        '-q', '--queries',
+        metavar='Q',
+        default=None,
+        type=str,
+        help='Query metadata filename produced by the driver (required unless serving)')
+    parser.add_argument(
+        '-d', '--dataset',
+        metavar='D',
+        default=None,
+        type=str,
+        help='Video dataset path (defaults to the source recorded by the driver)')
+    system = parser.add_mutually_exclusive_group()
+    system.add_argument(
+        '-c', '--command',
+        metavar='TEMPLATE',
+        default=None,
+        help='Command executed for each instance; {query}, {input}, {output}, {parameters} (JSON) '
+             'and each query parameter (e.g., {alpha}) are substituted')
+    system.add_argument(
+        '-p', '--plugin',
+        metavar='MODULE[:FUNCTION]',
+        default='reference',
+        help='Python callable invoked as function(dataset, query, instance, output) for each instance; '
+             '"reference" uses the verifier\'s reference implementations')
+    parser.add_argument(
+        '-o', '--output',
+        metavar='PATH',
+        default=RESULTS_PATH,
+        help='Directory for query results, the result YAML and (by default) the timing report')
+    parser.add_argument(
+        '-j', '--concurrency',
+        metavar='N',
+        default=1,
+        type=int,
+        help='Number of instances of a batch to execute concurrently')
+    parser.add_argument(
+        '--cold-runs',
+        metavar='N',
+        default=1,
+        type=int,
+        help='Number of runs of each batch preceded by the reset command')
+    parser.add_argument(
+        '--warm-runs',
+        metavar='N',
+        default=1,
+        type=int,
+        help='Number of subsequent runs of each batch')
+    parser.add_argument(
+        '--reset',
+        metavar='COMMAND',
+        default=None,
+        help='Shell command executed before each cold run')
+    parser.add_argument(
+        '-r', '--report',
+        metavar='FILE',
+        default=None,
+        help='Timing report YAML filename (defaults to report.yml in the output directory)')
+    parser.add_argument(
+        '-v', '--verify',
+        action='store_true',
+        help='Verify query results once all runs complete')
+    parser.add_argument(
+        '-s', '--serve',
+        metavar='PORT',
+        default=None,
+        type=int,
+        help='Rather than executing a workload, execute queries POSTed by the driver\'s replay mode')
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(CommandSystem(args.command) if args.command else load_plugin(args.plugin), args.serve, args.dataset, args.output)
+        sys.exit(0)
+    elif not args.queries:
+        parser.error('the following arguments are required: -q/--queries')
+
+    sys.exit(0 if execute(map(str.strip, args.batches.split(',')) if args.batches != 'all' else None,
+                          args.queries, args.dataset,
+                          CommandSystem(args.command) if args.command else load_plugin(args.plugin),
+                          args.output, args.concurrency, args.cold_runs, args.warm_runs, args.reset,
+                          args.report or os.path.join(args.output, 'report.yml'), args.verify)
+             else 1)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import os
+import logging
+import argparse
+import numpy as np
+import cv2
+
+SEMANTIC_FORMATS = ['palette', 'classid']
+CLASS_VIDEO_EXTENSION = '.mkv'
+FFV1_ARGUMENTS = ['-codec', 'ffv1', '-level', '3', '-slices', '4', '-slicecrc', '1']
+
+# CityScapes palette indexed by semantic tag, in BGR order
+CITYSCAPES_PALETTE = np.zeros((256, 3), dtype=np.uint8)
+CITYSCAPES_PALETTE[:13] = [
+    (0, 0, 0),        # Unlabeled
+    (70, 70, 70),     # Building
+    (153, 153, 190),  # Fence
+    (160, 170, 250),  # Other
+    (60, 20, 220),    # Pedestrian
+    (153, 153, 153),  # Pole
+    (50, 234, 157),   # Road line
+    (128, 64, 128),   # Road
+    (232, 35, 244),   # Sidewalk
+    (35, 142, 107),   # Vegetation
+    (142, 0, 0),      # Vehicle
+    (156, 102, 102),  # Wall
+    (0, 220, 220)]    # Traffic sign
+CITYSCAPES_LUT = CITYSCAPES_PALETTE.reshape(256, 1, 3)
+
+
+def get_class_video_path(video_path):
+    directory, basename = os.path.split(video_path)
+    return os.path.join(directory, 'semantic-' + os.path.splitext(basename)[0] + CLASS_VIDEO_EXTENSION)
+
+
+def read_class_frames(filename):
+    reader = cv2.VideoCapture(filename)
+    # Class ids are stored as a gray stream; avoid the conversion to BGR where the backend supports it
+    reader.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    try:
+        result, frame = reader.read()
+        while result:
+            yield frame if frame.ndim == 2 else frame[:, :, 0]
+            result, frame = reader.read()
+    finally:
+        reader.release()
+
+
+def render_palette(input_filename, output_filename):
+    logging.info('Rendering %s to %s', input_filename, output_filename)
+
+    reader = cv2.VideoCapture(input_filename)
+    fps = reader.get(cv2.CAP_PROP_FPS)
+    reader.release()
+
+    writer = None
+    frame = None
+
+    for tags in read_class_frames(input_filename):
+        if writer is None:
+            frame = np.empty(tags.shape + (3,), dtype=np.uint8)
+            writer = cv2.VideoWriter(output_filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, (tags.shape[1], tags.shape[0]))
+        cv2.cvtColor(tags, cv2.COLOR_GRAY2BGR, dst=frame)
+        cv2.LUT(frame, CITYSCAPES_LUT, dst=frame)
+        writer.write(frame)
+
+    if writer is not None:
+        writer.release()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Render class-id semantic segmentation videos with the CityScapes palette')
+    parser.add_argument(
+        'input',
+        nargs='+',
+        help='Class-id videos to render')
+    parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='Output directory (defaults to the directory of each input)')
+    args = parser.parse_args()
+
+    for filename in args.input:
+        directory = args.output or os.path.dirname(filename)
+        render_palette(filename, os.path.join(directory, os.path.splitext(os.path.basename(filename))[0] + '.mp4'))
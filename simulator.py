@@ -0,0 +1,68 @@
+import os
+import subprocess
+import signal
+import socket
+import importlib
+import logging
+import psutil
+from common import *
+
+# Allows generation to be exercised against a mock simulator module
+carla = importlib.import_module(os.environ.get('CARLA_MODULE', 'carla'))
+
+
+def get_weather(name):
+    return getattr(carla.WeatherParameters, name)
+
+
+def is_carla_running():
+    return any([p for p in psutil.process_iter(attrs=['name'])
+                if p.info['name'] == CARLA_PROCESS_NAME and not has_exited(p)])
+
+
+def has_exited(process):
+    try:
+        # A child process that has exited but not been reaped is still reported as running
+        return process.status() == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return True
+
+
+def is_port_open(hostname, port):
+    try:
+        with socket.create_connection((hostname, port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def start_carla(seed, fps=30, quality='Epic', executable=None, hostname='localhost', port=2000, timeout=READY_TIMEOUT):
+    if is_carla_running():
+        stop_carla(timeout)
+
+    executable = executable or os.environ['CARLA_EXECUTABLE']
+    process = subprocess.Popen([executable,
+                                '-benchmark',
+                                '-fps=%d' % fps,
+                                '-quality-level=%s' % quality,
+                                '-fixedseed=%d' % int(seed)], cwd=os.path.dirname(executable))
+
+    def is_ready():
+        if process.poll() is not None:
+            raise RuntimeError('Simulator exited with status %d during startup' % process.returncode)
+        return is_port_open(hostname, port)
+
+    logging.info('Simulator started in %.1f seconds', wait_until(is_ready, timeout))
+
+
+def stop_carla(timeout=READY_TIMEOUT):
+    if is_carla_running():
+        process = next(p for p in psutil.process_iter(attrs=['name'])
+                       if p.info['name'] == os.path.basename(os.environ['CARLA_EXECUTABLE']) and not has_exited(p))
+        process.send_signal(signal.SIGINT)
+
+        try:
+            logging.info('Simulator stopped in %.1f seconds', wait_until(lambda: has_exited(process), timeout))
+        except TimeoutError:
+            logging.warning('Simulator did not stop within %.1f seconds; killing it', timeout)
+            process.kill()
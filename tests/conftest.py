@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Tests import the top-level scripts directly and run generation against the mock simulator
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('CARLA_MODULE', 'mockcarla')
@@ -0,0 +1,242 @@
+import fnmatch
+import itertools
+import random
+import threading
+import numpy as np
+
+# A minimal stand-in for the simulator's Python API, loaded through CARLA_MODULE=mockcarla.
+# Spawned actors are recorded per world so tests can compare what two runs asked the simulator for.
+
+BLUEPRINTS = ['sensor.camera.rgb', 'sensor.camera.semantic_segmentation', 'controller.ai.walker',
+              'vehicle.audi.a2', 'vehicle.tesla.model3', 'walker.pedestrian.0001', 'walker.pedestrian.0002']
+SPAWN_POINTS = 200
+ROAD_LENGTH = 400
+SIDEWALK_OFFSET = 5
+PEDESTRIAN_TAG = 4
+VEHICLE_TAG = 10
+
+_actor_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+class WeatherParameters:
+    def __getattr__(self, name):
+        return name
+
+WeatherParameters = WeatherParameters()
+
+
+class LaneType:
+    Driving = 'Driving'
+    Sidewalk = 'Sidewalk'
+
+
+class Location:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = x, y, z
+
+    def __add__(self, other):
+        return Location(self.x + other.x, self.y + other.y, self.z + other.z)
+
+
+class Rotation:
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch, self.yaw, self.roll = pitch, yaw, roll
+
+
+class Transform:
+    def __init__(self, location=None, rotation=None):
+        self.location = location or Location()
+        self.rotation = rotation or Rotation()
+
+
+class Waypoint:
+    def __init__(self, location, lane_type):
+        self.transform = Transform(location)
+        self.lane_type = lane_type
+
+
+class Attribute:
+    recommended_values = ['255,0,0', '0,255,0', '0,0,255']
+
+
+class Blueprint:
+    def __init__(self, id):
+        self.id = id
+        self.attributes = {}
+
+    def has_attribute(self, name):
+        return name == 'color' and self.id.startswith('vehicle')
+
+    def get_attribute(self, name):
+        return Attribute()
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+
+class BlueprintLibrary(list):
+    def filter(self, pattern):
+        return [blueprint for blueprint in self if fnmatch.fnmatch(blueprint.id, pattern if '*' in pattern else '*%s*' % pattern)]
+
+    def find(self, id):
+        return next(blueprint for blueprint in self if blueprint.id == id)
+
+
+class command:
+    class SpawnActor:
+        def __init__(self, blueprint, transform, parent=None):
+            # Snapshot the blueprint and transform, as the simulator does when the command is built
+            self.blueprint = blueprint.id
+            self.attributes = dict(blueprint.attributes)
+            self.location = (transform.location.x, transform.location.y, transform.location.z)
+            self.yaw = transform.rotation.yaw
+            self.parent = parent
+
+        def then(self, command):
+            return self
+
+    class SetAutopilot:
+        def __init__(self, actor, enabled):
+            pass
+
+    class DestroyActor:
+        def __init__(self, actor):
+            pass
+
+    FutureActor = object()
+
+
+class Response:
+    def __init__(self, actor_id, error=''):
+        self.actor_id = actor_id
+        self.error = error
+
+
+class Image:
+    def __init__(self, raw_data):
+        self.raw_data = raw_data
+
+
+class Actor:
+    def __init__(self, blueprint, attributes):
+        with _lock:
+            self.id = next(_actor_ids)
+        self.type_id = blueprint
+        self.attributes = attributes
+        self.callback = None
+
+    def listen(self, callback):
+        self.callback = callback
+
+    def stop(self):
+        self.callback = None
+
+    def start(self):
+        pass
+
+    def go_to_location(self, location):
+        pass
+
+    def set_max_speed(self, speed):
+        pass
+
+
+class Map:
+    def __init__(self, name):
+        self.name = '/Game/Carla/Maps/' + name
+
+    def get_spawn_points(self):
+        return [Transform(Location(x=float(index), y=0.0)) for index in range(SPAWN_POINTS)]
+
+    def generate_waypoints(self, distance):
+        return [Waypoint(Location(x=float(x)), LaneType.Driving) for x in np.arange(0, ROAD_LENGTH, distance)]
+
+    def get_waypoint(self, location, project_to_road=True, lane_type=LaneType.Driving):
+        offset = SIDEWALK_OFFSET if lane_type == LaneType.Sidewalk else 0
+        return Waypoint(Location(location.x, location.y + offset, location.z), lane_type)
+
+
+class WorldSettings:
+    def __init__(self, synchronous_mode=False, fixed_delta_seconds=None):
+        self.synchronous_mode = synchronous_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+
+
+class World:
+    def __init__(self, map, settings=None):
+        self.map = Map(map)
+        self.settings = settings or WorldSettings()
+        self.frame = 0
+        self.actors = {}
+        self.spawned = []
+
+    def get_map(self):
+        return self.map
+
+    def get_settings(self):
+        return WorldSettings(self.settings.synchronous_mode, self.settings.fixed_delta_seconds)
+
+    def apply_settings(self, settings):
+        self.settings = WorldSettings(settings.synchronous_mode, settings.fixed_delta_seconds)
+
+    def set_weather(self, weather):
+        pass
+
+    def get_blueprint_library(self):
+        return BlueprintLibrary(Blueprint(id) for id in BLUEPRINTS)
+
+    def get_random_location_from_navigation(self):
+        # Like the simulator, draws from a generator shared by every world in the process
+        return Location(random.uniform(0, ROAD_LENGTH), SIDEWALK_OFFSET, 0.0)
+
+    def get_actors(self, ids):
+        return [self.actors[id] for id in ids]
+
+    def wait_for_tick(self, seconds):
+        # In synchronous mode the world only advances when a client ticks it
+        if self.settings.synchronous_mode:
+            raise RuntimeError('time-out of %.0f seconds while waiting for the simulator' % seconds)
+        return self.frame
+
+    def tick(self):
+        self.frame += 1
+        for actor in list(self.actors.values()):
+            if actor.callback:
+                width = int(actor.attributes['image_size_x'])
+                height = int(actor.attributes['image_size_y'])
+                image = np.zeros((height, width, 4), dtype=np.uint8)
+                if 'semantic' in actor.type_id:
+                    image[:height // 4, :width // 4, 2] = PEDESTRIAN_TAG
+                    image[height // 2:, width // 2:, 2] = VEHICLE_TAG
+                else:
+                    image[..., :3] = self.frame % 256
+                actor.callback(Image(image.tobytes()))
+        return self.frame
+
+
+class Client:
+    def __init__(self, hostname, port):
+        self.world = None
+
+    def set_timeout(self, seconds):
+        pass
+
+    def load_world(self, map):
+        # As the simulator does, the new map keeps the previous world's settings
+        self.world = World(map, self.world.settings if self.world else None)
+
+    def get_world(self):
+        return self.world
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        responses = []
+        for command_ in commands:
+            if isinstance(command_, command.SpawnActor):
+                actor = Actor(command_.blueprint, command_.attributes)
+                self.world.actors[actor.id] = actor
+                self.world.spawned.append((command_.blueprint, sorted(command_.attributes.items()), command_.location, command_.yaw))
+                responses.append(Response(actor.id))
+            else:
+                responses.append(Response(0))
+        return responses
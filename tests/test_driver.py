@@ -0,0 +1,88 @@
+import math
+import os
+import signal
+import socket
+import subprocess
+import sys
+import urllib.error
+import pytest
+import yaml
+import driver
+from common import CONFIGURATION_FILENAME, wait_until
+
+# Records each query and its parameters, and fails Q2a so that errors reach the dispatcher
+TEMPLATE = 'sh -c \'echo "$0 $1" >> {}; test "$0" != 2a\' {{query}} {{parameters}}'
+INSTANCE = {'path': 'traffic-000.mp4', 'alpha': 2, 'beta': 3}
+
+
+def get_free_port():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+def is_port_open(port):
+    with socket.socket() as probe:
+        return probe.connect_ex(('localhost', port)) == 0
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    path = tmp_path / 'dataset'
+    path.mkdir()
+    (path / CONFIGURATION_FILENAME).write_text(yaml.dump({'resolution': {'width': 320, 'height': 240}}))
+    return str(path)
+
+
+@pytest.fixture
+def log(tmp_path):
+    return tmp_path / 'queries.log'
+
+
+@pytest.fixture
+def endpoint(dataset, log, tmp_path):
+    port = get_free_port()
+    harness = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'harness.py')
+    process = subprocess.Popen([sys.executable, harness, '--serve', str(port), '-d', dataset,
+                                '-o', str(tmp_path / 'results'), '-c', TEMPLATE.format(log)])
+    try:
+        wait_until(lambda: is_port_open(port) or process.poll() is not None, timeout=30)
+        assert process.poll() is None
+        yield 'http://localhost:{}/'.format(port)
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=10)
+
+
+def test_http_dispatch_runs_query_on_harness(endpoint, dataset, log):
+    dispatch = driver.HTTPDispatcher(endpoint, dataset)
+
+    dispatch('4', INSTANCE)
+    with pytest.raises(urllib.error.HTTPError):
+        dispatch('2a', INSTANCE)
+
+    assert log.read_text().splitlines() == ['4 {"path": "traffic-000.mp4", "alpha": 2, "beta": 3}',
+                                            '2a {"path": "traffic-000.mp4", "alpha": 2, "beta": 3}']
+
+
+def test_command_dispatch_runs_query(dataset, log):
+    dispatch = driver.CommandDispatcher(TEMPLATE.format(log), {'path': dataset})
+
+    dispatch('4', INSTANCE)
+    with pytest.raises(subprocess.CalledProcessError):
+        dispatch('2a', INSTANCE)
+
+    assert log.read_text().splitlines()[0] == '4 {"path": "traffic-000.mp4", "alpha": 2, "beta": 3}'
+
+
+def test_replay_summary_rates_cover_own_queries():
+    records = [{'query': '2a', 'arrival': 0.0, 'start': 0.0, 'end': 0.002, 'error': None},
+               {'query': '1', 'arrival': 0.1, 'start': 0.1, 'end': 0.3, 'error': None},
+               {'query': '1', 'arrival': 0.6, 'start': 0.6, 'end': 0.8, 'error': None},
+               {'query': '1', 'arrival': 1.1, 'start': 1.1, 'end': 1.3, 'error': 'failed'}]
+
+    assert math.isnan(driver.summarize_replay(records[:1])['offered'])
+    assert math.isnan(driver.summarize_replay(records[:1])['throughput'])
+    summary = driver.summarize_replay(records[1:])
+    assert summary['offered'] == pytest.approx(2.0)
+    assert summary['throughput'] == pytest.approx(2.0)
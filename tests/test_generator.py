@@ -0,0 +1,87 @@
+import os
+import random
+import threading
+import pytest
+import generator
+import mockcarla
+
+SEED = 7
+RESOLUTION = (64, 48)
+DURATION = 1
+ENCODING = dict(generator.DEFAULT_ENCODING, encoder='mp4v')
+TILES = [generator.Tile('Town01', 'ClearNoon', 5, 8), generator.Tile('Town02', 'WetSunset', 3, 12)]
+
+
+def render(path, id, client=None):
+    client = client or mockcarla.Client('localhost', 2000)
+    generator.generate_tile(client, str(path), id, TILES[id], len(TILES), RESOLUTION, DURATION, None,
+                            encoding=ENCODING, seed=generator.get_tile_seed(SEED, id))
+    return client.get_world().spawned
+
+
+def test_tile_does_not_depend_on_earlier_tiles(tmp_path):
+    client = mockcarla.Client('localhost', 2000)
+    sequential = [render(tmp_path / 'sequential', id, client) for id in range(len(TILES))]
+
+    # Disturb the process-wide generator, as another tile rendering in this process would
+    random.seed(SEED + 1)
+    alone = render(tmp_path / 'alone', 1)
+
+    assert alone == sequential[1]
+
+
+def test_concurrent_tiles_match_sequential(tmp_path):
+    sequential = [render(tmp_path / 'sequential', id) for id in range(len(TILES))]
+    concurrent = [None] * len(TILES)
+
+    def run(id):
+        concurrent[id] = render(tmp_path / 'concurrent', id)
+
+    threads = [threading.Thread(target=run, args=(id,)) for id in range(len(TILES))]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+
+    assert concurrent == sequential
+
+
+def test_walkers_spawn_at_distinct_locations(tmp_path):
+    spawned = render(tmp_path, 0)
+    locations = [location for blueprint, _, location, _ in spawned if blueprint.startswith('walker')]
+
+    assert len(locations) == TILES[0].walkers
+    assert len(set(locations)) == len(locations)
+
+
+def install_encoder(path, monkeypatch, script):
+    encoder = path / 'bin' / 'ffmpeg'
+    encoder.parent.mkdir()
+    encoder.write_text('#!/bin/sh\n' + script)
+    encoder.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}:{}'.format(encoder.parent, os.environ['PATH']))
+
+
+def test_tile_fails_when_encoder_fails(tmp_path, monkeypatch):
+    install_encoder(tmp_path, monkeypatch, 'exit 1\n')
+
+    with pytest.raises(RuntimeError, match='Unable to write'):
+        generator.generate_tile(mockcarla.Client('localhost', 2000), str(tmp_path / 'dataset'), 0, TILES[0], len(TILES),
+                                RESOLUTION, DURATION, None, encoding=generator.DEFAULT_ENCODING, seed=SEED)
+
+
+def test_generation_fails_when_tile_outputs_are_missing(tmp_path, monkeypatch):
+    # The encoder succeeds without writing anything, so the tile cannot be recorded in the manifest
+    install_encoder(tmp_path, monkeypatch, 'cat > /dev/null\n')
+    path = str(tmp_path / 'dataset')
+
+    with pytest.raises(RuntimeError, match='not rendered'):
+        generator.generate(path, TILES[:1], 1, RESOLUTION, DURATION, None, SEED, servers=[('localhost', 2000)])
+
+    with open(os.path.join(path, generator.MANIFEST_FILENAME)) as stream:
+        assert generator.yaml.safe_load(stream)['tiles'][0]['state'] == generator.GenerationManifest.PENDING
+
+
+def test_tile_leaves_world_asynchronous(tmp_path):
+    client = mockcarla.Client('localhost', 2000)
+    render(tmp_path, 0, client)
+
+    assert not client.get_world().get_settings().synchronous_mode
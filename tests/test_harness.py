@@ -0,0 +1,73 @@
+import os
+import shutil
+import numpy as np
+import pytest
+import harness
+import verifier
+from common import get_truth_sidecar_path
+
+SHAPE = (120, 160)
+FRAMES = 8
+PEDESTRIAN_COLOR, VEHICLE_COLOR = verifier.SEGMENT_COLORS['pedestrian'], verifier.SEGMENT_COLORS['vehicle']
+
+pytestmark = pytest.mark.skipif(not shutil.which('ffmpeg'), reason='ffmpeg is required to encode videos')
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    # A textured source video with a pedestrian and two overlapping vehicles, and a truth sidecar listing their boxes
+    random = np.random.RandomState(0)
+    frames, boxes = [], []
+
+    for index in range(FRAMES):
+        frame = (random.rand(*SHAPE, 3) * 60 + 80).astype(np.uint8)
+        frame_boxes = [(0, 10 + index, 20, 12, 30), (1, 60, 50 + index, 40, 20), (1, 90, 55, 30, 25), (0, 150, 5, 2, 2)]
+        for label, x, y, width, height in frame_boxes:
+            frame[y:y + height, x:x + width] = PEDESTRIAN_COLOR if label == 0 else VEHICLE_COLOR
+        frames.append(frame)
+        boxes.append(np.array(frame_boxes, dtype=np.int32))
+
+    source_filename = str(tmp_path / 'traffic-000.mkv')
+    harness.write_video(source_filename, frames, 30)
+    np.savez(get_truth_sidecar_path(source_filename),
+             classes=np.array(['pedestrian', 'vehicle']),
+             shape=np.array(SHAPE),
+             offsets=np.cumsum([0] + [len(frame_boxes) for frame_boxes in boxes]),
+             boxes=np.concatenate(boxes))
+
+    verifier.truth_cache.clear()
+    return {'path': str(tmp_path)}
+
+
+@pytest.mark.parametrize('instance', [{'path': 'traffic-000.mkv'}, {'path': 'traffic-000.mkv', 'O': 'Pedestrian'}])
+def test_reference_system_passes_q6a(dataset, instance, tmp_path):
+    output_filename = str(tmp_path / 'result.mkv')
+    harness.reference_system(dataset, '6a', instance, output_filename)
+
+    frames = verifier.read_frames(os.path.join(dataset['path'], instance['path']))
+    result = verifier.validate_q6a(dataset, instance, frames, output_filename, {})
+
+    assert result.passed
+    assert result.mean == 1.0
+
+
+def test_unboxed_result_fails_q6a(dataset, tmp_path):
+    instance = {'path': 'traffic-000.mkv'}
+    output_filename = str(tmp_path / 'result.mkv')
+    harness.write_video(output_filename, verifier.read_frames(os.path.join(dataset['path'], instance['path'])), 30)
+
+    frames = verifier.read_frames(os.path.join(dataset['path'], instance['path']))
+    assert not verifier.validate_q6a(dataset, instance, frames, output_filename, {}).passed
+
+
+@pytest.mark.parametrize('memory_limit', [2**20, 2**10])
+def test_reference_system_passes_q4(dataset, memory_limit, tmp_path, monkeypatch):
+    # A small limit splits each frame into several strips
+    monkeypatch.setattr(harness.write_upscaled, '__defaults__', (memory_limit,))
+    instance = {'path': 'traffic-000.mkv', 'alpha': 2, 'beta': 3}
+    output_filename = str(tmp_path / 'result.mkv')
+    harness.reference_system(dataset, '4', instance, output_filename)
+
+    frames = verifier.read_frames(os.path.join(dataset['path'], instance['path']))
+    options = {'streaming': True, 'psnr': 'native', 'memory_limit': 1}
+    assert verifier.validate_q4(dataset, instance, frames, output_filename, options).passed
@@ -0,0 +1,110 @@
+import os
+import socket
+import sys
+import time
+import pytest
+import common
+import simulator
+
+# Stands in for the simulator: optionally exits or ignores SIGINT, and otherwise accepts connections after a delay
+FAKE_SIMULATOR = '''#!{}
+import os, signal, socket, sys, time
+if os.environ.get('FAKE_EXIT'):
+    sys.exit(int(os.environ['FAKE_EXIT']))
+if os.environ.get('FAKE_IGNORE_SIGINT'):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+time.sleep(float(os.environ.get('FAKE_STARTUP_DELAY', '0')))
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(('localhost', int(os.environ['FAKE_PORT'])))
+server.listen()
+while True:
+    server.accept()[0].close()
+'''
+
+
+# The fake is stopped by process name, so never run alongside a real simulator
+pytestmark = pytest.mark.skipif(simulator.is_carla_running(), reason='a simulator is already running')
+
+
+def get_free_port():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+@pytest.fixture
+def fake_simulator(tmp_path, monkeypatch):
+    # Named as the simulator process, so that it is found by is_carla_running and stop_carla
+    executable = tmp_path / simulator.CARLA_PROCESS_NAME
+    executable.write_text(FAKE_SIMULATOR.format(sys.executable))
+    executable.chmod(0o755)
+
+    port = get_free_port()
+    monkeypatch.setenv('CARLA_EXECUTABLE', str(executable))
+    monkeypatch.setenv('FAKE_PORT', str(port))
+    yield port
+
+    simulator.stop_carla(timeout=1)
+
+
+def test_wait_until_backs_off_exponentially(monkeypatch):
+    delays = []
+    monkeypatch.setattr(common.time, 'sleep', delays.append)
+    results = iter([False] * 4 + [True])
+
+    common.wait_until(lambda: next(results), timeout=10, initial_delay=0.1, max_delay=0.3)
+
+    assert delays == pytest.approx([0.1, 0.2, 0.3, 0.3])
+
+
+def test_wait_until_raises_at_deadline():
+    start = time.time()
+
+    with pytest.raises(TimeoutError):
+        common.wait_until(lambda: False, timeout=0.2, initial_delay=0.05)
+    assert time.time() - start < 1
+
+
+def test_is_port_open():
+    with socket.socket() as server:
+        server.bind(('localhost', 0))
+        server.listen()
+        port = server.getsockname()[1]
+        assert simulator.is_port_open('localhost', port)
+
+    assert not simulator.is_port_open('localhost', port)
+
+
+def test_start_carla_waits_for_port(fake_simulator, monkeypatch):
+    monkeypatch.setenv('FAKE_STARTUP_DELAY', '0.3')
+
+    simulator.start_carla(1, port=fake_simulator, timeout=10)
+
+    assert simulator.is_port_open('localhost', fake_simulator)
+    assert simulator.is_carla_running()
+
+
+def test_start_carla_fails_when_simulator_exits(fake_simulator, monkeypatch):
+    monkeypatch.setenv('FAKE_EXIT', '3')
+
+    with pytest.raises(RuntimeError, match='status 3'):
+        simulator.start_carla(1, port=fake_simulator, timeout=10)
+
+
+def test_stop_carla_waits_for_exit(fake_simulator):
+    simulator.start_carla(1, port=fake_simulator, timeout=10)
+
+    simulator.stop_carla(timeout=10)
+
+    # The stopped process is never reaped by its parent here, so it remains as a zombie
+    assert not simulator.is_carla_running()
+
+
+def test_stop_carla_kills_unresponsive_simulator(fake_simulator, monkeypatch):
+    monkeypatch.setenv('FAKE_IGNORE_SIGINT', '1')
+    simulator.start_carla(1, port=fake_simulator, timeout=10)
+
+    simulator.stop_carla(timeout=0.5)
+
+    common.wait_until(lambda: not simulator.is_carla_running(), timeout=5)
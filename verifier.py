@@ -1,278 +1,993 @@
 #!/usr/bin/python3
 
 import subprocess
+import math
+import re
+import json
+import pickle
 import cv2
 import tempfile
+import shutil
 import logging
 import argparse
+import sys
+import queue
+import threading
+from collections import OrderedDict
 import numpy as np
-from sklearn.metrics import jaccard_similarity_score
 from itertools import zip_longest
+from concurrent.futures import ProcessPoolExecutor
 from common import *
+from segmentation import read_class_frames, get_class_video_path
 
 
 ALL_QUERIES = "1,2a,2b,2c,2d,3,4,5,6a,6b".split(',')
+SEGMENT_COLORS = {'pedestrian': (60, 20, 220), 'vehicle': (142, 0, 0)}  # BGR
+SEGMENT_COLOR_THRESHOLD = 50
+TRUTH_CACHE_SIZE = 16
+FANOUT_QUEUE_DEPTH = 8
+FANOUT_POLL_INTERVAL = 0.1
+# Private to the user, since cache entries are unpickled
+WORKLOAD_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'visualroad', 'verifier')
+WORKLOAD_CACHE_VERSION = 1
+BITRATE_TOLERANCE = 0.1
+OVERLAY_DIFFERENCE_THRESHOLD = 64
+OVERLAY_MINIMUM_BOX_SIZE = 4
+OVERLAY_BOX_COLOR = (0, 255, 0)  # BGR
+OVERLAY_BOX_THICKNESS = 1
+CAPTION_EXTENSION = '.srt'
+CAPTION_FONT = cv2.FONT_HERSHEY_SIMPLEX
+CAPTION_SCALE = 1
+CAPTION_THICKNESS = 2
+CAPTION_MARGIN = 10
+CAPTION_COLOR = (255, 255, 255)  # BGR
+STRIP_MEMORY_LIMIT = 256  # MB
+STRIP_BYTES_PER_SAMPLE = 8  # Result and reference strips, plus the int32 difference and resize slack
 
 def load_yaml(filename):
     with open(filename, 'r') as stream:
-        return yaml.safe_load(stream)
+        return yaml.load(stream, Loader=YAML_LOADER)
 
 
-def load_queries(filename):
-    return load_yaml(filename)
+def load_cached(filename, load, cache_path=WORKLOAD_CACHE_PATH):
+    if not cache_path:
+        return load(filename)
+
+    # Keyed by content, so an edited workload is never served from a stale entry
+    cache_filename = os.path.join(cache_path, '{}-{}-{}.pickle'.format(
+        load.__name__, WORKLOAD_CACHE_VERSION, get_checksum(filename)))
+
+    if os.path.exists(cache_filename):
+        logging.info('Loading %s from cache %s', filename, cache_filename)
+        with open(cache_filename, 'rb') as file:
+            return pickle.load(file)
+
+    value = load(filename)
+
+    try:
+        os.makedirs(cache_path, mode=0o700, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_path, delete=False) as file:
+            pickle.dump(value, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, cache_filename)
+    except OSError as e:
+        logging.warning('Unable to cache %s: %s', filename, e)
+
+    return value
+
+
+def load_jsonl_queries(stream):
+    queries = {'batches': []}
+    batches = {}
+
+    for line in stream:
+        if not line.strip():
+            continue
+        instance = json.loads(line)
+        queries['source'] = instance['source']
+        if instance['query'] not in batches:
+            batches[instance['query']] = {'query': instance['query'], 'batch': []}
+            queries['batches'].append(batches[instance['query']])
+        batches[instance['query']]['batch'].append({'query': instance['parameters']})
+
+    return queries
+
 
+def read_queries(filename):
+    # The driver emits either a YAML document or JSON Lines, one query instance per line
+    with open(filename, 'r') as stream:
+        if stream.read(1) == '{':
+            stream.seek(0)
+            return load_jsonl_queries(stream)
 
-def load_results(filename):
     return load_yaml(filename)
 
 
+def index_queries(filename):
+    queries = read_queries(filename)
+    return {'source': queries.get('source'),
+            'queries': {batch['query']: [q['query'] for q in batch['batch']] for batch in queries['batches']}}
+
+
+def index_results(filename):
+    return {result['query']: result['result'] for result in load_yaml(filename)}
+
+
+def load_queries(filename, cache_path=WORKLOAD_CACHE_PATH):
+    return load_cached(filename, index_queries, cache_path)
+
+
+def load_results(filename, cache_path=WORKLOAD_CACHE_PATH):
+    return load_cached(filename, index_results, cache_path)
+
+
 def get_queries(queries, query_id):
-    queries = next(batch for batch in queries['batches'] if batch['query'] == str(query_id))['batch']
-    return [q['query'] for q in queries]
+    return queries['queries'][str(query_id)]
 
 
 def get_results(results, query_id):
-    return next(result for result in results if result['query'] == str(query_id))['result']
+    return results[str(query_id)]
 
 
-def get_writer(filename, reader, width=None, height=None):
+def get_fps(filename):
+    reader = cv2.VideoCapture(filename)
     fps = reader.get(cv2.CAP_PROP_FPS)
-    width = width or int(reader.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = height or int(reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    reader.release()
+    return fps
 
-    return cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height), True)
 
+def get_resolution(filename):
+    reader = cv2.VideoCapture(filename)
+    resolution = int(reader.get(cv2.CAP_PROP_FRAME_WIDTH)), int(reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    reader.release()
+    return resolution
 
-def assert_psnr(filename, reference_filename, threshold):
-    subprocess.run(['./assert-psnr.sh', filename, reference_filename, str(threshold)])
 
+def write_frames(filename, frames, fps):
+    writer = None
 
-def validate_query(query_id, queries, dataset, results, validator):
-    logging.info('Validating Q%s', query_id)
+    for frame in frames:
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        if writer is None:
+            height, width = frame.shape[:2]
+            writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height), True)
+        writer.write(frame)
 
-    for i, (query, result_filename) in enumerate(zip_longest(get_queries(queries, query_id), get_results(results, query_id))):
-        logging.info('Instance %d', i)
+    if writer is not None:
+        writer.release()
 
-        validator(dataset, query, result_filename)
 
+class PSNRResult:
+    def __init__(self, errors, threshold, mean=None):
+        self.errors = list(errors)
+        self.threshold = threshold
+        self.frames = [mse_to_psnr(error) for error in self.errors]
+        # As in ffmpeg's psnr filter, the mean PSNR is derived from the mean squared error over all frames
+        self.mean = mean if mean is not None else mse_to_psnr(np.mean(self.errors)) if self.errors else math.nan
+        self.minimum = min(self.frames, default=self.mean)
 
-def validate_q1(dataset, query, result_filename):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
-        index = 0
-        result = True
-        reader = cv2.VideoCapture(os.path.join(dataset['path'], query['path']))
-        writer = get_writer(output.name, reader,
-                            width=query['x'][1] - query['x'][0] + 1,
-                            height=query['y'][1] - query['y'][0] + 1)
+    @property
+    def passed(self):
+        return self.mean >= self.threshold
 
-        while result:
-            index += 1
-            result, frame = reader.read()
-            if result and index in range(*query['t']):
-                cropped = frame[query['y'][0]:query['y'][1] + 1, query['x'][0]:query['x'][1] + 1, :]
-                writer.write(cropped)
+    @property
+    def status(self):
+        return 0 if self.passed else 1
 
-        writer.release()
+    def __str__(self):
+        if self.passed:
+            return 'PASS: PSNR {}'.format(self.mean)
+        else:
+            return 'FAIL: calculated PSNR {} below limit of {}'.format(self.mean, self.threshold)
+
+
+def mse_to_psnr(mse):
+    return 10 * math.log10(255 ** 2 / mse) if mse > 0 else math.inf
 
-        assert_psnr(result_filename, output.name, LOSSLESS_PSNR_THRESHOLD)
 
+def frame_mse(frame, reference):
+    if reference.ndim < frame.ndim:
+        reference = reference[..., np.newaxis]
+    if frame.shape[:2] != reference.shape[:2]:
+        raise RuntimeError("Result frame shape {} does not match reference shape {}.".format(
+            frame.shape, reference.shape))
 
-def validate_q2a(dataset, query, result_filename):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
-        reader = cv2.VideoCapture(os.path.join(dataset['path'], query['path']))
-        writer = get_writer(output.name, reader)
-        result = True
+    difference = np.subtract(frame, reference, dtype=np.int32).ravel()
+    return np.einsum('i,i->', difference, difference, dtype=np.int64) / difference.size
 
+
+def read_frames(filename):
+    reader = cv2.VideoCapture(filename)
+    try:
+        result, frame = reader.read()
         while result:
+            yield frame
             result, frame = reader.read()
-            if result:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                writer.write(gray)
+    finally:
+        reader.release()
+
+
+class FrameFanout:
+    def __init__(self, filename, count, depth=FANOUT_QUEUE_DEPTH):
+        self.filename = filename
+        self.queues = [queue.Queue(depth) for _ in range(count)]
+        self.closed = [False] * count
+
+    def consumer(self, index):
+        return FanoutConsumer(self, index)
+
+    def close(self, index):
+        self.closed[index] = True
+
+    def run(self):
+        try:
+            for frame in read_frames(self.filename):
+                # Frames are shared by every consumer, so guard against in-place modification
+                frame.setflags(write=False)
+                for index in range(len(self.queues)):
+                    self._put(index, frame)
+                if all(self.closed):
+                    break
+        finally:
+            for index in range(len(self.queues)):
+                self._put(index, None)
+
+    def _put(self, index, frame):
+        while not self.closed[index]:
+            try:
+                self.queues[index].put(frame, timeout=FANOUT_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+
+class FanoutConsumer:
+    def __init__(self, fanout, index):
+        self.fanout = fanout
+        self.index = index
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        frame = None if self.fanout.closed[self.index] else self.fanout.queues[self.index].get()
+        if frame is None:
+            raise StopIteration
+        return frame
+
+    def close(self):
+        self.fanout.close(self.index)
+
+
+def compute_psnr(frames, reference_frames, threshold):
+    errors = []
+
+    for frame, reference in zip_longest(frames, reference_frames):
+        if frame is None:
+            raise RuntimeError("Unexpected EOF in result video.")
+        elif reference is None:
+            raise RuntimeError("Too many frames in result video.")
+        errors.append(frame_mse(frame, reference))
 
-        writer.release()
+    return PSNRResult(errors, threshold)
 
-        assert_psnr(result_filename, output.name, LOSSLESS_PSNR_THRESHOLD)
 
+def native_psnr(filename, reference_filename, threshold):
+    return compute_psnr(read_frames(filename), read_frames(reference_filename), threshold)
 
-def validate_q2b(dataset, query, result_filename):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
-        reader = cv2.VideoCapture(os.path.join(dataset['path'], query['path']))
-        writer = get_writer(output.name, reader)
-        kernel = query['d']
-        result = True
 
-        while result:
-            result, frame = reader.read()
-            if result:
-                blurred = cv2.blur(frame, (kernel, kernel))
-                writer.write(blurred)
+def script_psnr(filename, reference_filename, threshold):
+    process = subprocess.run(['./assert-psnr.sh', filename, reference_filename, str(threshold)],
+                             stdout=subprocess.PIPE, universal_newlines=True)
+    match = re.search(r'PSNR ([\d.]+|inf)', process.stdout)
+    return PSNRResult([], threshold, mean=float(match.group(1)) if match else math.nan)
 
-        writer.release()
 
-        assert_psnr(result_filename, output.name, LOSSLESS_PSNR_THRESHOLD)
+PSNR_ENGINES = {
+    'native': native_psnr,
+    'ffmpeg': script_psnr
+}
 
 
-def validate_q2c(dataset, query, result_filename):
-    segment_colors = {'pedestrian': (60, 20, 220), 'vehicle': (142, 0, 0)}  # BGR
-    objects = query['objects'] if 'objects' in query else ['pedestrian', 'vehicle']
-    threshold = 50
+def assert_psnr(filename, reference_filename, threshold, engine='native'):
+    return PSNR_ENGINES[engine](filename, reference_filename, threshold)
 
-    truth_reader = cv2.VideoCapture(os.path.join(dataset['path'], query['path']))
-    result_reader = cv2.VideoCapture(result_filename)
-    segmented_result = True
-    index = 0
-    iou_total = 0
 
-    while segmented_result:
-        segmented_result, segmented_frame = truth_reader.read()
-        result_result, result_frame = result_reader.read()
-        truth_frame= np.full_like(segmented_result, 0)
-        index += 1
+class JaccardResult:
+    def __init__(self, ious, objects, threshold, frame=None):
+        self.ious = np.array(ious, dtype=np.float64).reshape(-1, len(objects))
+        self.objects = objects
+        self.threshold = threshold
+        self.frame = frame
+        self.mean = self.ious.mean() if self.ious.size else math.nan
+        self.minimum = self.ious.min() if self.ious.size else math.nan
+
+    @property
+    def class_means(self):
+        return dict(zip(self.objects, self.ious.mean(axis=0)))
+
+    @property
+    def passed(self):
+        return self.frame is None and self.mean >= self.threshold
+
+    def __str__(self):
+        if self.passed:
+            return 'PASS: Mean Jaccard {}'.format(self.mean)
+        elif self.frame is not None:
+            return 'FAIL: calculated Jaccard {} below limit of {} on frame {}'.format(
+                self.ious[-1].min(), self.threshold, self.frame)
+        else:
+            return 'FAIL: calculated Jaccard {} below limit of {}'.format(self.mean, self.threshold)
+
+
+class TileResult:
+    def __init__(self, tiles, budget, tolerance=BITRATE_TOLERANCE):
+        # Each tile is a (row, column, PSNRResult, bitrate) tuple
+        self.tiles = tiles
+        self.budget = budget
+        self.limit = budget * (1 + tolerance)
+
+    def compliant(self, bitrate):
+        return bitrate <= self.limit
+
+    @property
+    def failures(self):
+        return [tile for tile in self.tiles if not tile[2].passed or not self.compliant(tile[3])]
+
+    @property
+    def passed(self):
+        return not self.failures
+
+    def __str__(self):
+        if self.passed:
+            return 'PASS: {} tiles within bitrate {}, minimum PSNR {}'.format(
+                len(self.tiles), self.budget, min(tile[2].mean for tile in self.tiles))
+        else:
+            return 'FAIL: ' + '; '.join(
+                'tile ({}, {}) bitrate {:.0f} {} budget {}, PSNR {} {} limit of {}'.format(
+                    row, column, bitrate, 'within' if self.compliant(bitrate) else 'exceeds', self.budget,
+                    psnr.mean, 'within' if psnr.passed else 'below', psnr.threshold)
+                for row, column, psnr, bitrate in self.failures)
+
+
+def pack_colors(frame):
+    frame = np.asarray(frame, dtype=np.uint32)
+    return frame[..., 0] | (frame[..., 1] << 8) | (frame[..., 2] << 16)
+
+
+def label_frame(frame, colors):
+    # Label 0 is background; pixels exactly matching colors[i] are labeled i + 1
+    keys = pack_colors(colors)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    packed = pack_colors(frame)
+    positions = np.minimum(np.searchsorted(sorted_keys, packed), len(keys) - 1)
+    return np.where(sorted_keys[positions] == packed, order[positions] + 1, 0).astype(np.uint8)
+
+
+def mask_iou(labels, truth_labels, classes):
+    # Intersection and union for every class from a single joint histogram of both label frames
+    counts = np.bincount(truth_labels.ravel().astype(np.intp) * (classes + 1) + labels.ravel(),
+                         minlength=(classes + 1) ** 2).reshape(classes + 1, classes + 1)
+    intersection = np.diag(counts)[1:]
+    union = counts[1:, :].sum(axis=1) + counts[:, 1:].sum(axis=0) - intersection
+    return np.divide(intersection, union, out=np.ones(classes), where=union > 0)
+
+
+class InstanceResult:
+    def __init__(self, query_id, index, result=None, error=None):
+        self.query_id = query_id
+        self.index = index
+        self.result = result
+        self.error = error
+
+    @property
+    def passed(self):
+        return self.error is None and self.result.passed
+
+    def __str__(self):
+        return str(self.result) if self.error is None else 'FAIL: {}'.format(self.error)
+
+
+def validate_query(query_id, queries, results):
+    return [(query_id, index, query, result_filename)
+            for index, (query, result_filename)
+            in enumerate(zip_longest(get_queries(queries, query_id), get_results(results, query_id)))]
+
+
+def validate_instance(query_id, index, query, result_filename, dataset, options, frames):
+    logging.info('Validating Q%s instance %d', query_id, index)
+
+    try:
+        return InstanceResult(query_id, index,
+                              result=VERIFIERS[query_id](dataset, query, frames, result_filename, options))
+    except Exception as e:
+        logging.exception('Q%s instance %d failed', query_id, index)
+        return InstanceResult(query_id, index, error=str(e))
+
+
+def validate_source(source_filename, instances, dataset, options):
+    if len(instances) == 1:
+        return [validate_instance(*instances[0], dataset, options, read_frames(source_filename))]
+
+    logging.info('Sharing %s across %d instances', source_filename, len(instances))
+
+    fanout = FrameFanout(source_filename, len(instances))
+    instance_results = [None] * len(instances)
+
+    def consume(index):
+        try:
+            instance_results[index] = validate_instance(*instances[index], dataset, options, fanout.consumer(index))
+        finally:
+            fanout.close(index)
+
+    threads = [threading.Thread(target=consume, args=(index,)) for index in range(len(instances))]
+    [thread.start() for thread in threads]
+    fanout.run()
+    [thread.join() for thread in threads]
+
+    return instance_results
+
+
+def print_summary(instance_results):
+    print('{:<8}{:<10}{:<8}{}'.format('Query', 'Instance', 'Status', 'Detail'))
+    for instance in instance_results:
+        print('{:<8}{:<10}{:<8}{}'.format(instance.query_id, instance.index,
+                                          'PASS' if instance.passed else 'FAIL', instance))
+
+
+def psnr_verifier(reference, threshold=LOSSLESS_PSNR_THRESHOLD):
+    def verifier(dataset, query, frames, result_filename, options):
+        source_filename = os.path.join(dataset['path'], query['path'])
+        reference_frames = reference(query, frames)
+
+        if options['streaming'] and options['psnr'] == 'native':
+            return compute_psnr(read_frames(result_filename), reference_frames, threshold)
+        else:
+            with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
+                write_frames(output.name, reference_frames, get_fps(source_filename))
+                return assert_psnr(result_filename, output.name, threshold, options['psnr'])
+
+    return verifier
+
+
+def validate_q1(query, frames):
+    for index, frame in enumerate(frames, 1):
+        if index in range(*query['t']):
+            yield frame[query['y'][0]:query['y'][1] + 1, query['x'][0]:query['x'][1] + 1, :]
+        elif index >= query['t'][1]:
+            break
+
+
+def validate_q2a(query, frames):
+    for frame in frames:
+        yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def validate_q2b(query, frames):
+    kernel = query['d']
+
+    for frame in frames:
+        yield cv2.blur(frame, (kernel, kernel))
+
 
-        if not result_result and segmented_result:
+class TruthTrack:
+    def __init__(self):
+        self.shape = None
+        self.boxes = []
+        self.complete = False
+        self.lock = threading.Lock()
+
+
+truth_cache = OrderedDict()
+truth_cache_lock = threading.Lock()
+
+
+def component_boxes(mask):
+    _, _, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(mask, 8, cv2.CV_32S, cv2.CCL_GRANA)
+    return stats[1:, :4].copy()  # Skip the background component
+
+
+def segment_boxes(segmented_frame, colors, threshold=SEGMENT_COLOR_THRESHOLD):
+    return [component_boxes(cv2.inRange(segmented_frame, tuple(t - threshold for t in color),
+                                                         tuple(t + threshold for t in color)))
+            for color in colors]
+
+
+def class_boxes(class_frame, tags):
+    # Class ids are stored losslessly, so no color threshold is needed
+    return [component_boxes(cv2.inRange(class_frame, tag, tag)) for tag in tags]
+
+
+def rasterize_boxes(shape, boxes):
+    height, width = shape
+    labels = np.zeros(shape, dtype=np.uint8)
+    corners = np.empty((height + 1, width + 1), dtype=np.float32)
+
+    # Later classes overwrite earlier ones, as when drawing each box in turn
+    for label, class_boxes in enumerate(boxes, 1):
+        if not len(class_boxes):
+            continue
+
+        # Boxes are inclusive of their far edge; accumulate corner deltas and integrate once per class
+        x0, y0 = class_boxes[:, 0], class_boxes[:, 1]
+        x1 = np.minimum(x0 + class_boxes[:, 2] + 1, width)
+        y1 = np.minimum(y0 + class_boxes[:, 3] + 1, height)
+
+        corners.fill(0)
+        np.add.at(corners, (y0, x0), 1)
+        np.add.at(corners, (y0, x1), -1)
+        np.add.at(corners, (y1, x0), -1)
+        np.add.at(corners, (y1, x1), 1)
+        coverage = cv2.integral(corners[:height, :width], sdepth=cv2.CV_32F)
+
+        np.putmask(labels, coverage[1:, 1:] > 0.5, label)
+
+    return labels
+
+
+def load_truth_sidecar(filename, objects):
+    track = TruthTrack()
+
+    with np.load(filename) as sidecar:
+        classes = list(sidecar['classes'])
+        indices = [classes.index(object) for object in objects]
+        track.shape = tuple(sidecar['shape'].tolist())
+        track.boxes = [[frame_boxes[frame_boxes[:, 0] == index, 1:] for index in indices]
+                       for frame_boxes in np.split(sidecar['boxes'], sidecar['offsets'][1:-1])]
+
+    track.complete = True
+    return track
+
+
+def load_class_track(filename, objects):
+    track = TruthTrack()
+    tags = [SEGMENTATION_TAGS[object] for object in objects]
+
+    for frame in read_class_frames(filename):
+        track.shape = frame.shape
+        track.boxes.append(class_boxes(frame, tags))
+
+    track.complete = True
+    return track
+
+
+def get_truth_track(source_filename, objects):
+    key = (source_filename, tuple(objects))
+    sidecar_filename = get_truth_sidecar_path(source_filename)
+    class_filename = get_class_video_path(source_filename)
+
+    with truth_cache_lock:
+        if key not in truth_cache:
+            if os.path.exists(sidecar_filename):
+                truth_cache[key] = load_truth_sidecar(sidecar_filename, objects)
+            elif os.path.exists(class_filename):
+                truth_cache[key] = load_class_track(class_filename, objects)
+            else:
+                truth_cache[key] = TruthTrack()
+            if len(truth_cache) > TRUTH_CACHE_SIZE:
+                truth_cache.popitem(last=False)
+        truth_cache.move_to_end(key)
+        return truth_cache[key]
+
+
+def truth_labels(source_filename, frames, objects):
+    # Boxes for each source frame are computed by whichever instance reaches it first and reused by the rest
+    colors = [SEGMENT_COLORS[object] for object in objects]
+    track = get_truth_track(source_filename, objects)
+
+    if track.complete:
+        frames.close()
+        for boxes in track.boxes:
+            yield rasterize_boxes(track.shape, boxes)
+        return
+
+    for index, frame in enumerate(frames):
+        yield rasterize_boxes(frame.shape[:2], frame_truth_boxes(track, index, frame, colors))
+
+    track.complete = True
+
+
+def frame_truth_boxes(track, index, frame, colors):
+    with track.lock:
+        if index == len(track.boxes):
+            track.shape = frame.shape[:2]
+            track.boxes.append(segment_boxes(frame, colors))
+        return track.boxes[index]
+
+
+def validate_q2c(dataset, query, frames, result_filename, options):
+    objects = query['objects'] if 'objects' in query else ['pedestrian', 'vehicle']
+    colors = [SEGMENT_COLORS[object] for object in objects]
+    ious = []
+
+    truth = truth_labels(os.path.join(dataset['path'], query['path']), frames, objects)
+
+    for index, (truth_frame, result_frame) in enumerate(zip_longest(truth, read_frames(result_filename)), 1):
+        if result_frame is None:
             raise RuntimeError("Unexpected EOF in result video.")
-        elif not segmented_result and result_result:
+        elif truth_frame is None:
             raise RuntimeError("Too many frames in result video.")
-        elif segmented_result:
-            # Generate truth frame
-            for object in objects:
-                color = segment_colors[object]
-                thresholded = cv2.inRange(segmented_frame, tuple(t - threshold for t in color),
-                                                           tuple(t + threshold for t in color))
-                _, contours, hierarchy = cv2.findContours(thresholded, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-
-                for contour in contours:
-                    x, y, w, h = cv2.boundingRect(contour)
-                    cv2.rectangle(truth_frame, (x, y), (x + w, y + h), color, cv2.FILLED)
-
-            # For each class, compare to result frame
-            for object in objects:
-                color = segment_colors[object]
-                thresholded_result = cv2.inRange(result_frame, color, color)
-                thresholded_truth = cv2.inRange(truth_frame, color, color)
-                iou = jaccard_similarity_score(thresholded_result, thresholded_truth)
-                iou_total += iou
-                if iou < JACCARD_THRESHOLD:
-                    print('FAIL: calculated Jaccard {} below limit of {} on frame {}'.format(
-                        iou, JACCARD_THRESHOLD, index))
-                    return
-
-    print('PASS: Mean Jaccard {}'.format(iou_total / index))
-
-
-def validate_q2d(dataset, query, result_filename):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
-        reader = cv2.VideoCapture(os.path.join(dataset['path'], query['path']))
-        writer = get_writer(output.name, reader)
-
-        window_size = query['m']
-        epsilon = query['epsilon']
-        omega = 0
-        result = True
-        queue = []
-
-        def write_frame():
-            mean = np.average(queue, axis=0)
-            current = queue.pop(0)
-            current[np.abs(current - mean) < epsilon] = omega
-            writer.write(current)
+        elif result_frame.shape[:2] != truth_frame.shape:
+            raise RuntimeError("Result frame shape {} does not match reference shape {}.".format(
+                result_frame.shape, truth_frame.shape))
+
+        ious.append(mask_iou(label_frame(result_frame, colors), truth_frame, len(colors)))
+        if ious[-1].min() < JACCARD_THRESHOLD:
+            return JaccardResult(ious, objects, JACCARD_THRESHOLD, frame=index)
+
+    return JaccardResult(ious, objects, JACCARD_THRESHOLD)
+
+
+def validate_q2d(query, frames):
+    window_size = query['m']
+    epsilon = query['epsilon']
+    omega = 0
+    window = total = mean = mask = None
+    head = count = 0
+
+    # Each yielded frame is a slot in the ring buffer and is overwritten once the next frame is requested
+    def next_frame():
+        nonlocal head, count
+        current = window[head]
+
+        np.divide(total, count, out=mean)
+        np.subtract(current, mean, out=mean)
+        np.abs(mean, out=mean)
+        np.less(mean, epsilon, out=mask)
+        np.subtract(total, current, out=total)
+        np.putmask(current, mask, omega)
+
+        head = (head + 1) % window_size
+        count -= 1
+        return current
+
+    for frame in frames:
+        if window is None:
+            window = np.empty((window_size,) + frame.shape, dtype=frame.dtype)
+            total = np.zeros(frame.shape, dtype=np.int32)
+            mean = np.empty(frame.shape, dtype=np.float64)
+            mask = np.empty(frame.shape, dtype=np.bool_)
+
+        np.copyto(window[(head + count) % window_size], frame)
+        total += frame
+        count += 1
+
+        if count >= window_size:
+            yield next_frame()
+
+    while count:
+        yield next_frame()
+
+
+def validate_q3(dataset, query, frames, result_filename, options):
+    source_filename = os.path.join(dataset['path'], query['path'])
+    # Tiles are listed in row-major order, one result video per tile
+    filenames = [result_filename] if isinstance(result_filename, str) else list(result_filename)
+    width, height = query['dx'], query['dy']
+    tiles = readers = errors = None
+    count = 0
+
+    try:
+        for frame in frames:
+            if tiles is None:
+                tiles = [(top, left) for top in range(0, frame.shape[0], height) for left in range(0, frame.shape[1], width)]
+                if len(tiles) != len(filenames):
+                    raise RuntimeError("Expected {} tile videos, found {}.".format(len(tiles), len(filenames)))
+                readers = [read_frames(filename) for filename in filenames]
+                errors = [[] for _ in tiles]
+
+            for (top, left), reader, tile_errors in zip(tiles, readers, errors):
+                tile = next(reader, None)
+                if tile is None:
+                    raise RuntimeError("Unexpected EOF in result video.")
+                tile_errors.append(frame_mse(tile, frame[top:top + height, left:left + width]))
+            count += 1
+
+        if not count:
+            raise RuntimeError("Empty source video.")
+        elif any(next(reader, None) is not None for reader in readers):
+            raise RuntimeError("Too many frames in result video.")
+    finally:
+        for reader in readers or []:
+            reader.close()
+
+    duration = count / get_fps(source_filename)
+    results = []
+
+    for (top, left), filename, tile_errors in zip(tiles, filenames, errors):
+        psnr = PSNRResult(tile_errors, LOSSY_PSNR_THRESHOLD)
+        bitrate = os.path.getsize(filename) * 8 / duration
+        logging.info('Tile (%d, %d) %s: bitrate %.0f of budget %d, PSNR %s',
+                     top // height, left // width, filename, bitrate, query['B'], psnr.mean)
+        results.append((top // height, left // width, psnr, bitrate))
+
+    return TileResult(results, query['B'])
+
+
+def upscale_frames(query, frames):
+    alpha = query['alpha']
+    beta = query['beta']
+
+    for frame in frames:
+        height, width = frame.shape[:2]
+        yield cv2.resize(frame, (width*alpha, height*beta), interpolation=cv2.INTER_LINEAR)
+
+
+def upscale_strip(frame, top, bottom, alpha, beta):
+    # With integer factors, resizing source rows plus one row of context either side
+    # reproduces exactly the same output rows as resizing the whole frame
+    start, end = max(top - 1, 0), min(bottom + 1, frame.shape[0])
+    strip = cv2.resize(frame[start:end], (frame.shape[1]*alpha, (end - start)*beta), interpolation=cv2.INTER_LINEAR)
+    return strip[(top - start)*beta:(bottom - start)*beta]
+
+
+def read_exactly(stream, buffer):
+    view = memoryview(buffer).cast('B')
+    offset = 0
+
+    while offset < len(view):
+        count = stream.readinto(view[offset:])
+        if not count:
+            break
+        offset += count
+
+    return offset
+
+
+def strip_psnr(query, frames, result_filename, threshold, memory_limit):
+    alpha = query['alpha']
+    beta = query['beta']
+    resolution = get_resolution(result_filename)
+    process = None
+    errors = []
+
+    try:
+        for frame in frames:
+            height, width = frame.shape[:2]
+
+            if process is None:
+                if resolution != (width*alpha, height*beta):
+                    raise RuntimeError("Result frame shape {} does not match reference shape {}.".format(
+                        resolution[::-1], (height*beta, width*alpha)))
+                # Source rows per strip, so that a strip of the upscaled frame fits within the memory limit
+                rows = max(1, memory_limit // (resolution[0] * 3 * beta * STRIP_BYTES_PER_SAMPLE))
+                logging.info('Comparing %dx%d frames in strips of %d rows', resolution[0], resolution[1], rows*beta)
+                # Decoded frames are piped as raw rows, so a whole result frame is never held in memory
+                process = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', result_filename,
+                                            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'], stdout=subprocess.PIPE)
+                result = np.empty((rows*beta, resolution[0], 3), dtype=np.uint8)
+
+            error = 0
+            for top in range(0, height, rows):
+                bottom = min(top + rows, height)
+                strip = result[:(bottom - top)*beta]
+                if read_exactly(process.stdout, strip) < strip.nbytes:
+                    raise RuntimeError("Unexpected EOF in result video.")
+                error += frame_mse(strip, upscale_strip(frame, top, bottom, alpha, beta)) * strip.size
+            errors.append(error / (resolution[0] * resolution[1] * 3))
+
+        if process is not None and process.stdout.read(1):
+            raise RuntimeError("Too many frames in result video.")
+    finally:
+        if process is not None:
+            process.kill()
+            process.stdout.close()
+            process.wait()
 
-        while result:
-            result, frame = reader.read()
-            if result:
-                queue.append(frame)
-            if len(queue) >= window_size:
-                write_frame()
+    return PSNRResult(errors, threshold)
 
-        while queue:
-            write_frame()
 
-        writer.release()
+def validate_q4(dataset, query, frames, result_filename, options):
+    if options['streaming'] and options['psnr'] == 'native' and shutil.which('ffmpeg'):
+        return strip_psnr(query, frames, result_filename, LOSSLESS_PSNR_THRESHOLD, options['memory_limit'] * 2**20)
+    else:
+        if options['streaming'] and options['psnr'] == 'native':
+            logging.warning('ffmpeg not found; comparing whole upscaled Q4 frames, without a memory limit')
+        return psnr_verifier(upscale_frames)(dataset, query, frames, result_filename, options)
 
-        assert_psnr(result_filename, output.name, LOSSLESS_PSNR_THRESHOLD)
 
+def validate_q5(query, frames):
+    alpha = query['alpha']
+    beta = query['beta']
 
-def validate_q3(dataset, query, result_filename):
-    raise RuntimeError("Unimplemented")
+    for frame in frames:
+        height, width = frame.shape[:2]
+        yield cv2.resize(frame, (int(width / alpha), int(height / beta)), interpolation=cv2.INTER_LINEAR)
 
 
-def validate_q4(dataset, query, result_filename):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
-        reader = cv2.VideoCapture(os.path.join(dataset['path'], query['path']))
-        writer = get_writer(output.name, reader)
+def draw_boxes(frame, boxes, color=OVERLAY_BOX_COLOR, thickness=OVERLAY_BOX_THICKNESS):
+    # Boxes are (x, y, width, height); the outline covers the box's own pixels, so its far edge is x + width - 1
+    frame = frame.copy()
+    for x, y, width, height in boxes:
+        cv2.rectangle(frame, (int(x), int(y)), (int(x + width - 1), int(y + height - 1)), color, thickness)
+    return frame
 
-        alpha = query['alpha']
-        beta = query['beta']
-        width = int(reader.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        result = True
 
-        while result:
-            result, frame = reader.read()
-            if result:
-                resized = cv2.resize(frame, (height*beta, width*alpha), cv2.INTER_LINEAR)
-                writer.write(resized)
+def overlay_boxes(frame, source_frame, threshold=OVERLAY_DIFFERENCE_THRESHOLD, size=OVERLAY_MINIMUM_BOX_SIZE):
+    # Boxes are recovered from the pixels the overlay changed; small components are encoding noise
+    difference = cv2.absdiff(frame, source_frame)
+    mask = cv2.inRange(difference.max(axis=2), threshold + 1, 255)
+    boxes = component_boxes(mask)
+    return boxes[(boxes[:, 2] >= size) & (boxes[:, 3] >= size)]
 
-        writer.release()
 
-        assert_psnr(result_filename, output.name, LOSSLESS_PSNR_THRESHOLD)
+def box_ious(boxes, other_boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 1, 4)
+    other_boxes = np.asarray(other_boxes, dtype=np.float64).reshape(1, -1, 4)
+    width = np.minimum(boxes[..., 0] + boxes[..., 2], other_boxes[..., 0] + other_boxes[..., 2]) - np.maximum(boxes[..., 0], other_boxes[..., 0])
+    height = np.minimum(boxes[..., 1] + boxes[..., 3], other_boxes[..., 1] + other_boxes[..., 3]) - np.maximum(boxes[..., 1], other_boxes[..., 1])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    union = boxes[..., 2] * boxes[..., 3] + other_boxes[..., 2] * other_boxes[..., 3] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
 
 
-def validate_q5(dataset, query, result_filename):
-    with tempfile.NamedTemporaryFile(suffix='.mp4') as output:
-        reader = cv2.VideoCapture(os.path.join(dataset['path'], query['path']))
-        writer = get_writer(output.name, reader)
+def match_boxes(truth_boxes, result_boxes):
+    # Greedily pairs the most overlapping boxes; every unmatched box on either side counts against the score
+    if not len(truth_boxes) and not len(result_boxes):
+        return 1.0
 
-        alpha = query['alpha']
-        beta = query['beta']
-        width = int(reader.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        result = True
+    ious = box_ious(truth_boxes, result_boxes)
+    matched_truth, matched_results, matched = set(), set(), []
 
-        while result:
-            result, frame = reader.read()
-            if result:
-                resized = cv2.resize(frame, (int(height / beta), int(width / alpha)), cv2.INTER_LINEAR)
-                writer.write(resized)
+    for truth, result in zip(*np.unravel_index(np.argsort(-ious, axis=None, kind='stable'), ious.shape)):
+        if ious[truth, result] <= 0:
+            break
+        elif truth not in matched_truth and result not in matched_results:
+            matched_truth.add(truth)
+            matched_results.add(result)
+            matched.append(ious[truth, result])
+
+    return sum(matched) / (len(truth_boxes) + len(result_boxes) - len(matched))
+
+
+def validate_q6a(dataset, query, frames, result_filename, options):
+    objects = [query['O'].lower()] if 'O' in query else ['pedestrian', 'vehicle']
+    source_filename = os.path.join(dataset['path'], query['path'])
+    track = get_truth_track(source_filename, objects)
+    ious = []
+
+    if not track.complete:
+        raise RuntimeError("No ground truth for {}; generate the dataset with --truth or --semantic-format classid.".format(
+            source_filename))
+
+    for index, (frame, result_frame) in enumerate(zip_longest(frames, read_frames(result_filename)), 1):
+        if result_frame is None:
+            raise RuntimeError("Unexpected EOF in result video.")
+        elif frame is None:
+            raise RuntimeError("Too many frames in result video.")
+        elif result_frame.shape != frame.shape:
+            raise RuntimeError("Result frame shape {} does not match reference shape {}.".format(
+                result_frame.shape, frame.shape))
+
+        # Truth boxes are drawn and recovered exactly as the result's are, so merged or faint outlines affect both alike.
+        # Drawn boxes carry no class, so every object class is compared as one.
+        truth_boxes = overlay_boxes(draw_boxes(frame, np.concatenate(track.boxes[index - 1])), frame)
+        ious.append(match_boxes(truth_boxes, overlay_boxes(result_frame, frame)))
+        if ious[-1] < JACCARD_THRESHOLD:
+            return JaccardResult(ious, ['+'.join(objects)], JACCARD_THRESHOLD, frame=index)
+
+    return JaccardResult(ious, ['+'.join(objects)], JACCARD_THRESHOLD)
+
+
+def parse_timestamp(timestamp):
+    hours, minutes, seconds = timestamp.replace(',', '.').split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def load_captions(filename):
+    captions = []
+
+    with open(filename, 'r', encoding='utf-8-sig') as file:
+        for block in re.split(r'\n\s*\n', file.read().strip()):
+            lines = block.splitlines()
+            for index, line in enumerate(lines):
+                match = re.match(r'\s*([\d:,.]+)\s*-->\s*([\d:,.]+)', line)
+                if match:
+                    captions.append((parse_timestamp(match.group(1)), parse_timestamp(match.group(2)), lines[index + 1:]))
+                    break
+
+    return sorted(captions, key=lambda caption: caption[0])
 
-        writer.release()
 
-        assert_psnr(result_filename, output.name, LOSSLESS_PSNR_THRESHOLD)
+def get_caption_path(dataset, query):
+    # The caption path names either an SRT file or a directory holding one per source video
+    caption_path = os.path.join(dataset['path'], query['caption_path'])
+    if os.path.isdir(caption_path):
+        return os.path.join(caption_path, os.path.splitext(os.path.basename(query['path']))[0] + CAPTION_EXTENSION)
+    return caption_path
 
 
-def validate_q6a(dataset, query, result_filename):
-    raise RuntimeError("Unimplemented")
+def draw_caption(frame, lines):
+    frame = frame.copy()
+    bottom = frame.shape[0] - CAPTION_MARGIN
 
+    for line in reversed(lines):
+        (width, height), baseline = cv2.getTextSize(line, CAPTION_FONT, CAPTION_SCALE, CAPTION_THICKNESS)
+        cv2.putText(frame, line, ((frame.shape[1] - width) // 2, bottom - baseline),
+                    CAPTION_FONT, CAPTION_SCALE, CAPTION_COLOR, CAPTION_THICKNESS, cv2.LINE_AA)
+        bottom -= height + baseline + CAPTION_MARGIN
 
-def validate_q6b(dataset, query, result_filename):
-    raise RuntimeError("Unimplemented")
+    return frame
+
+
+def caption_frames(captions, fps, frames):
+    index = 0
+
+    for frame_index, frame in enumerate(frames):
+        seconds = frame_index / fps
+        while index < len(captions) and captions[index][1] <= seconds:
+            index += 1
+        # Frames without a caption are passed through untouched
+        yield draw_caption(frame, captions[index][2]) if index < len(captions) and captions[index][0] <= seconds else frame
+
+
+def validate_q6b(dataset, query, frames, result_filename, options):
+    source_filename = os.path.join(dataset['path'], query['path'])
+    caption_filename = get_caption_path(dataset, query)
+
+    if not os.path.isfile(caption_filename):
+        raise RuntimeError("Caption file {} not found.".format(caption_filename))
+
+    captions = load_captions(caption_filename)
+    fps = get_fps(source_filename)
+    return psnr_verifier(lambda query, frames: caption_frames(captions, fps, frames))(
+        dataset, query, frames, result_filename, options)
 
 
 VERIFIERS = {
-    '1':  validate_q1,
-    '2a': validate_q2a,
-    '2b': validate_q2b,
+    '1':  psnr_verifier(validate_q1),
+    '2a': psnr_verifier(validate_q2a),
+    '2b': psnr_verifier(validate_q2b),
     '2c': validate_q2c,
-    '2d': validate_q2d,
+    '2d': psnr_verifier(validate_q2d),
     '3':  validate_q3,
     '4':  validate_q4,
-    '5':  validate_q5,
+    '5':  psnr_verifier(validate_q5),
     '6a': validate_q6a,
     '6b': validate_q6b
 }
 
 
-def validate(validate_set, queries_filename, dataset_path, results_filename):
-    queries = load_queries(queries_filename)
+def validate(validate_set, queries_filename, dataset_path, results_filename, psnr='native', streaming=True, jobs=1,
+             cache_path=WORKLOAD_CACHE_PATH, memory_limit=STRIP_MEMORY_LIMIT):
+    queries = load_queries(queries_filename, cache_path)
     dataset = load_configuration(dataset_path or queries['source'])
-    results = load_results(results_filename)
+    results = load_results(results_filename, cache_path)
+    options = {'psnr': psnr, 'streaming': streaming, 'memory_limit': memory_limit}
+    instances = []
 
     for q in validate_set:
         if q in VERIFIERS:
-            validate_query(q, queries, dataset, results, VERIFIERS[q])
+            instances += validate_query(q, queries, results)
         else:
             print('Unsupported query {} in verifier'.format(q))
 
+    sources = {}
+    for instance in instances:
+        sources.setdefault(os.path.join(dataset['path'], instance[2]['path']), []).append(instance)
+
+    # Instances sharing a source decode it once, but a source is split across workers rather than leave any idle
+    groups = max(1, -(-jobs // len(sources))) if sources else 1
+    arguments = [(source_filename, source_instances[group::groups], dataset, options)
+                 for source_filename, source_instances in sources.items()
+                 for group in range(min(groups, len(source_instances)))]
+
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = [pool.submit(validate_source, *source) for source in arguments]
+            source_results = [future.result() for future in futures]
+    else:
+        source_results = [validate_source(*source) for source in arguments]
+
+    indexed_results = {(instance.query_id, instance.index): instance
+                       for instance_results in source_results for instance in instance_results}
+    instance_results = [indexed_results[instance[:2]] for instance in instances]
+
+    print_summary(instance_results)
+
+    return all(instance.passed for instance in instance_results)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -303,7 +1018,41 @@ if __name__ == '__main__':
         required=True,
         type=str,
         help='Query result YAML filename')
+    parser.add_argument(
+        '-p', '--psnr',
+        default='native',
+        choices=PSNR_ENGINES.keys(),
+        help='PSNR engine; "ffmpeg" falls back to assert-psnr.sh')
+    parser.add_argument(
+        '-m', '--materialize',
+        action='store_true',
+        help='Write reference videos to temporary files before comparison (implied by --psnr ffmpeg)')
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N',
+        default=1,
+        type=int,
+        help='Number of processes verifying instances in parallel; instances sharing a source video share its decoding when there are more instances than processes')
+    parser.add_argument(
+        '-c', '--cache',
+        metavar='PATH',
+        default=WORKLOAD_CACHE_PATH,
+        help='Directory caching parsed query and result files, keyed by content hash (defaults to %s); only use a directory that other users cannot write' % WORKLOAD_CACHE_PATH)
+    parser.add_argument(
+        '--no-cache',
+        action='store_const',
+        dest='cache',
+        const=None,
+        help='Always parse query and result files')
+    parser.add_argument(
+        '--memory-limit',
+        metavar='MB',
+        default=STRIP_MEMORY_LIMIT,
+        type=int,
+        help='Approximate memory ceiling for comparing each upscaled (Q4) frame, which is done in strips')
     args = parser.parse_args()
 
-    validate(map(str.strip, args.validate.split(',')) if args.validate != 'all' else ALL_QUERIES,
-             args.queries, args.dataset, args.results)
+    sys.exit(0 if validate(map(str.strip, args.validate.split(',')) if args.validate != 'all' else ALL_QUERIES,
+                           args.queries, args.dataset, args.results, args.psnr, not args.materialize, args.jobs, args.cache,
+                           args.memory_limit)
+             else 1)
@@ -0,0 +1,28 @@
+import subprocess
+import logging
+import numpy as np
+
+
+class FFmpegWriter:
+    def __init__(self, filename, fps, resolution, arguments, pixel_format='bgr24'):
+        self.filename = filename
+        self.process = subprocess.Popen(['ffmpeg',
+                                         '-y',
+                                         '-loglevel', 'error',
+                                         '-f', 'rawvideo',
+                                         '-pix_fmt', pixel_format,
+                                         '-s', '%dx%d' % tuple(resolution),
+                                         '-r', str(fps),
+                                         '-i', '-'] +
+                                        arguments +
+                                        [filename],
+                                        stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            logging.error('Encoder exited with status %d for %s', self.process.returncode, self.filename)
+        return self.process.returncode == 0